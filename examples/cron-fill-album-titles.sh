@@ -0,0 +1,12 @@
+#!/usr/bin/env bash
+
+CRON_LOG=/path/to/cron-logs/fill_album_titles.log
+VENV_PYTHON=/path/to/virtual-env/bin/python
+PROJECT_BASE=/path/to/project/base
+MAX_ALBUMS=100
+
+cd $PROJECT_BASE
+echo START $(date) >> $CRON_LOG
+$VENV_PYTHON $PROJECT_BASE/manage.py fill_album_titles --limit $MAX_ALBUMS >> $CRON_LOG 2>&1
+echo END $(date) >> $CRON_LOG
+echo >> $CRON_LOG
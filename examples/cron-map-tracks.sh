@@ -3,10 +3,14 @@
 CRON_LOG=/path/to/cron-logs/load_playlist_$LOGID.log
 VENV_PYTHON=/path/to/virtual-env/bin/python
 PROJECT_BASE=/path/to/project/base
-MAX_TRACKS=150
+# The workers share the Spotify request rate limit (SPOTIFY_REQUESTS_PER_SECOND), and each song takes a few
+# requests, so more workers than about half the allowed requests per second mostly wait for the rate limiter.
+# Raise MAX_TRACKS along with WORKERS, so that a run still finishes well before the next one starts.
+MAX_TRACKS=600
+WORKERS=4
 
 cd $PROJECT_BASE
 echo START $(date) >> $CRON_LOG
-$VENV_PYTHON $PROJECT_BASE/manage.py map_tracks --limit $MAX_TRACKS >> $CRON_LOG 2>&1
+$VENV_PYTHON $PROJECT_BASE/manage.py map_tracks --limit $MAX_TRACKS --workers $WORKERS >> $CRON_LOG 2>&1
 echo END $(date) >> $CRON_LOG
 echo >> $CRON_LOG
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class RestConfig(AppConfig):
     name = 'rest'
+
+    def ready(self):
+        # The history feed is kept up to date through the signals sent by rphistory and trackmap.
+        import rest.receivers
@@ -0,0 +1,148 @@
+from datetime import datetime, timedelta
+from hashlib import md5
+import math
+from uuid import uuid4
+from django.core.cache import caches
+from django.db.models import Max
+from pytz import utc
+
+from .models import HistoryFeed, json_history_date_period
+from .settings import (
+    REST_HISTORY_CACHE, REST_HISTORY_BUCKET_SECONDS, REST_HISTORY_CLOSED_PERIOD_TTL, REST_HISTORY_LIVE_PERIOD_TTL)
+from .util import utc_now
+
+
+LATEST_PLAY_KEY = 'rest:history:latest_play'
+FEED_GENERATION_KEY = 'rest:history:feed_generation'
+
+
+def history_cache():
+    return caches[REST_HISTORY_CACHE]
+
+
+def history_changed():
+    """
+    Invalidates the cached history of the live period.  Call this after new plays were saved.
+    """
+    history_cache().set(LATEST_PLAY_KEY, latest_play_timestamp(from_cache=False), None)
+
+
+def feed_changed():
+    """
+    Invalidates all cached history.  Call this after plays that may already be cached changed, e.g. when
+    the title or the Spotify tracks of a song changed, or when older plays were added.
+    """
+    history_cache().set(FEED_GENERATION_KEY, uuid4().hex, None)
+
+
+def feed_generation():
+    """
+    :return: string identifying the current state of the history feed; it is part of all history cache keys
+    """
+    cache = history_cache()
+    generation = cache.get(FEED_GENERATION_KEY)
+    if generation is None:
+        # A new random value, so that entries cached before the value was lost are not used again.
+        generation = uuid4().hex
+        if not cache.add(FEED_GENERATION_KEY, generation, None):
+            generation = cache.get(FEED_GENERATION_KEY, generation)
+    return generation
+
+
+def latest_play_timestamp(from_cache=True):
+    """
+    :return: int: unix timestamp of the latest play in the history feed (0 if there are none)
+    """
+    if from_cache:
+        timestamp = history_cache().get(LATEST_PLAY_KEY)
+        if timestamp is not None:
+            return timestamp
+
+    latest = HistoryFeed.objects.aggregate(latest=Max('played_at'))['latest']
+    timestamp = int(latest.timestamp()) if latest else 0
+    if from_cache:
+        history_cache().set(LATEST_PLAY_KEY, timestamp, None)
+    return timestamp
+
+
+def bucket_timestamp(time, round_up=False):
+    """
+    :param bool round_up: round up instead of down
+    :return: int: unix timestamp of time, rounded to a multiple of REST_HISTORY_BUCKET_SECONDS
+    """
+    timestamp = math.ceil(time.timestamp()) if round_up else int(time.timestamp())
+    remainder = timestamp % REST_HISTORY_BUCKET_SECONDS
+    if round_up and remainder:
+        return timestamp + REST_HISTORY_BUCKET_SECONDS - remainder
+    return timestamp - remainder
+
+
+def etag_for(data):
+    return '"{}"'.format(md5(data.encode('utf-8')).hexdigest())
+
+
+def cached(key, ttl, iter_data):
+    """
+    Gets the cached data, or streams the data and caches it once it has been completely streamed.
+
+    :param iter_data: function returning a generator of strings which together form the data
+    :return: tuple (etag, data) if the data is cached, or (None, generator of data chunks) if not
+    """
+    value = history_cache().get(key)
+    if value is not None:
+        return value
+
+    def stream():
+        chunks = []
+        for chunk in iter_data():
+            chunks.append(chunk)
+            yield chunk
+        data = ''.join(chunks)
+        history_cache().set(key, (etag_for(data), data), ttl)
+
+    return None, stream()
+
+
+def cached_history_date_period(country, time_start, time_end):
+    """
+    Gets the history of the period as json, from the cache if possible.
+
+    The start of the period is rounded down, and the end rounded up, to REST_HISTORY_BUCKET_SECONDS, so that
+    all of the requested plays are included.  Periods that end before the latest play are closed: no more new
+    plays will be added to them, so they are cached for a long time.  The cache entries of periods that are
+    still live are invalidated when a new play is saved.  All cache entries are invalidated when already
+    cached plays change (see feed_changed).
+
+    :return: tuple (etag, json string), or (None, generator of json chunks) if not cached
+    """
+    start = bucket_timestamp(time_start)
+    end = bucket_timestamp(time_end, round_up=True)
+    latest = latest_play_timestamp()
+    generation = feed_generation()
+    if end < latest:
+        key = 'rest:history:period:{}:{}:{}:{}'.format(generation, country, start, end)
+        ttl = REST_HISTORY_CLOSED_PERIOD_TTL
+    else:
+        key = 'rest:history:period:{}:{}:{}:{}:{}'.format(generation, country, start, end, latest)
+        ttl = REST_HISTORY_LIVE_PERIOD_TTL
+
+    return cached(key, ttl, lambda: json_history_date_period(
+        country, datetime.fromtimestamp(start, utc), datetime.fromtimestamp(end, utc), stream=True))
+
+
+def last_24_hours(country):
+    """
+    Gets the history of the last 24 hours as json, from the cache if possible.
+
+    The cache entry is invalidated when a new play is saved or the feed changes, and otherwise expires after
+    REST_HISTORY_LIVE_PERIOD_TTL seconds, so that the oldest plays drop out of the period.
+
+    :return: tuple (etag, json string), or (None, generator of json chunks) if not cached
+    """
+    key = 'rest:history:last_24_hours:{}:{}:{}'.format(feed_generation(), country, latest_play_timestamp())
+
+    def iter_data():
+        end = utc_now()
+        return json_history_date_period(country, end - timedelta(days=1), end, stream=True)
+
+    return cached(key, REST_HISTORY_LIVE_PERIOD_TTL, iter_data)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest.history_cache import history_cache
+from rest.models import HistoryFeed, HistoryFeedTrack
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the history feed used by the REST history endpoint from the play history and track mappings'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            plays = HistoryFeed.objects.rebuild()
+            tracks = HistoryFeedTrack.objects.refresh_songs()
+        history_cache().clear()
+        self.stdout.write("History feed rebuilt with {} plays and {} song / country tracks".format(plays, tracks))
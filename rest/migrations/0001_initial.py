@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-17 15:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('rphistory', '0006_increse_isrc_field_lenth_20160304_1947'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistoryFeed',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('played_at', models.DateTimeField(help_text='Play time, truncated to the second', unique=True)),
+                ('rp_song_id', models.IntegerField()),
+                ('title', models.CharField(max_length=255)),
+                ('artist_name', models.CharField(max_length=255)),
+                ('album_title', models.CharField(blank=True, max_length=255)),
+                ('asin', models.CharField(max_length=64)),
+                ('song', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='rphistory.Song')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='HistoryFeedTrack',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('country', models.CharField(max_length=2)),
+                ('spotify_track_id', models.CharField(max_length=120)),
+                ('spotify_album_img_small_url', models.URLField(null=True)),
+                ('spotify_album_img_large_url', models.URLField(null=True)),
+                ('song', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='rphistory.Song')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='historyfeedtrack',
+            unique_together=set([('song', 'country')]),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Fills the history feed from the existing play history and track mappings, as the rebuild_history_feed command
+# does (see HistoryFeedManager.add_plays and HistoryFeedTrackManager.refresh_songs).
+POPULATE_HISTORY_FEED_SQL = '''
+    INSERT INTO rest_historyfeed (played_at, song_id, rp_song_id, title, artist_name, album_title, asin)
+    SELECT DISTINCT ON (date_trunc('second', h.played_at))
+           date_trunc('second', h.played_at) AS played_at,
+           s.id AS song_id,
+           s.rp_song_id,
+           COALESCE(s.corrected_title, s.title) AS title,
+           artist.name AS artist_name,
+           album.title AS album_title,
+           album.asin
+      FROM rphistory_history h
+      JOIN rphistory_song s ON h.song_id = s.id
+      JOIN rphistory_artist_songs ras ON s.id = ras.song_id
+      JOIN rphistory_artist artist ON artist.id = ras.artist_id
+      JOIN rphistory_album album ON album.id = s.album_id
+  ORDER BY date_trunc('second', h.played_at), artist.id DESC
+  ON CONFLICT (played_at) DO NOTHING;
+
+    INSERT INTO rest_historyfeedtrack
+                (song_id, country, spotify_track_id, spotify_album_img_small_url, spotify_album_img_large_url)
+    SELECT DISTINCT ON (ta.rp_song_id, ta.country)
+           ta.rp_song_id,
+           ta.country,
+           track.spotify_id,
+           spot_album.img_medium_url,
+           spot_album.img_large_url
+      FROM trackmap_trackavailability ta
+      JOIN trackmap_track track ON track.id = ta.track_id
+      JOIN trackmap_album spot_album ON spot_album.id = track.album_id
+  ORDER BY ta.rp_song_id, ta.country, ta.score DESC, ta.id
+  ON CONFLICT (song_id, country) DO NOTHING;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest', '0001_initial'),
+        ('trackmap', '0002_trackavailability_score'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            POPULATE_HISTORY_FEED_SQL,
+            reverse_sql='TRUNCATE rest_historyfeed, rest_historyfeedtrack',
+        ),
+    ]
@@ -1,69 +1,279 @@
-from django.db import connection
+from uuid import uuid4
+from django.db import connection, models, transaction
 
 
-def history(country,
-            l2_where_clause="1", l2_order_by_clause='', l2_limit_clause='', l2_params=None,
-            l1_limit_clause='', l1_params=None):
+# Reference country is the one that is used to find tracks, as long as the Spotify API is no longer providing
+# all the country details when searching, or until another workaround is made.
+REFERENCE_COUNTRY = 'CH'
 
-    l2_params = l2_params or []
-    l1_params = l1_params or []
-    # Reference country is the one that is used to find tracks, as long as the Spotify API is no longer providing
-    # all the country details when searching, or until another workaround is made.
-    reference_country = 'CH'
-    params = [country, country, reference_country] + l2_params + l1_params
 
-    # Subquery with DISTINCT is used to eliminate some duplicate artist -> track mappings that happen
-    # where Radio Paradise changes song artist information and that song is reprocessed by the map_tracks command.
-    # There are also some duplicate entries for songs that were reported played at, for example, 12:30:00 AND
-    # 12:30:00.120999.
+def invalidate_history_cache(cached_plays_changed):
+    """
+    Invalidates the cached history when the current transaction commits (or right away, outside of a transaction).
+
+    :param bool cached_plays_changed: True if plays that may already be cached changed, False if only
+                                      new plays were added
+    """
+    # Imported here, as history_cache uses this module.
+    from .history_cache import feed_changed, history_changed
+    transaction.on_commit(feed_changed if cached_plays_changed else history_changed)
+
+
+class HistoryFeedManager(models.Manager):
+    # Selects the feed values of the songs; for songs with several artists, the artist with the highest id is used.
+    song_values_sql = '''
+        SELECT {distinct_on}
+               {played_at}
+               s.id AS song_id,
+               s.rp_song_id,
+               COALESCE(s.corrected_title, s.title) AS title,
+               artist.name AS artist_name,
+               album.title AS album_title,
+               album.asin
+          FROM {from_clause}
+          JOIN rphistory_artist_songs ras ON s.id = ras.song_id
+          JOIN rphistory_artist artist ON artist.id = ras.artist_id
+          JOIN rphistory_album album ON album.id = s.album_id
+         WHERE {where_clause}
+      ORDER BY {order_by}, artist.id DESC
+        '''
+
+    def add_plays(self, played_at_times=None):
+        """
+        Adds the plays to the feed.  Plays that are already in the feed are ignored.
+
+        Plays are stored with a precision of one second, which eliminates the duplicate entries for songs that
+        were reported played at, for example, 12:30:00 AND 12:30:00.120999.
+
+        :param played_at_times: list of History.played_at values, or None to add all plays
+        :return: count of plays added
+        """
+        if played_at_times is not None and not played_at_times:
+            return 0
+        latest = self.aggregate(latest=models.Max('played_at'))['latest']
+
+        select_sql = self.song_values_sql.format(
+            distinct_on="DISTINCT ON (date_trunc('second', h.played_at))",
+            played_at="date_trunc('second', h.played_at) AS played_at,",
+            from_clause='rphistory_history h JOIN rphistory_song s ON h.song_id = s.id',
+            where_clause='h.played_at = ANY(%s)' if played_at_times is not None else 'TRUE',
+            order_by="date_trunc('second', h.played_at)",
+        )
+        sql = '''
+            INSERT INTO {feed} (played_at, song_id, rp_song_id, title, artist_name, album_title, asin)
+            {select_sql}
+            ON CONFLICT (played_at) DO NOTHING
+              RETURNING played_at
+            '''.format(feed=self.model._meta.db_table, select_sql=select_sql)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [list(played_at_times)] if played_at_times is not None else [])
+            added = [row[0] for row in cursor.fetchall()]
+        if added:
+            # Plays added before the latest play (e.g. imported from archived playlists) may be in cached periods.
+            invalidate_history_cache(latest is not None and min(added) < latest)
+        return len(added)
+
+    def refresh_songs(self, song_ids):
+        """
+        Updates the song values (title, artist, album) of the songs' plays, e.g. after a title was corrected.
+
+        :param song_ids: iterable of rphistory.Song ids
+        :return: count of plays updated
+        """
+        song_ids = list(song_ids)
+        if not song_ids:
+            return 0
+
+        sql = '''
+            UPDATE {feed} f
+               SET rp_song_id = song.rp_song_id,
+                   title = song.title,
+                   artist_name = song.artist_name,
+                   album_title = song.album_title,
+                   asin = song.asin
+              FROM ({select_sql}) song
+             WHERE f.song_id = song.song_id
+            '''.format(
+            feed=self.model._meta.db_table,
+            select_sql=self.song_values_sql.format(
+                distinct_on='DISTINCT ON (s.id)',
+                played_at='',
+                from_clause='rphistory_song s',
+                where_clause='s.id = ANY(%s)',
+                order_by='s.id',
+            ))
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [song_ids])
+            updated = cursor.rowcount
+        if updated:
+            invalidate_history_cache(True)
+        return updated
+
+    def rebuild(self):
+        """
+        Rebuilds the feed from the full play history.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('TRUNCATE {}'.format(self.model._meta.db_table))
+        invalidate_history_cache(True)
+        return self.add_plays()
+
+
+class HistoryFeed(models.Model):
+    """
+    Denormalized Radio Paradise play history, used by the REST history endpoint.
+
+    It is kept up to date through the signals sent when plays are saved and songs change (see rest.receivers);
+    the Spotify track of each song is in HistoryFeedTrack.
+    """
+    played_at = models.DateTimeField(unique=True, help_text="Play time, truncated to the second")
+    song = models.ForeignKey('rphistory.Song', related_name='+')
+    rp_song_id = models.IntegerField()
+    title = models.CharField(max_length=255)
+    artist_name = models.CharField(max_length=255)
+    album_title = models.CharField(max_length=255, blank=True)
+    asin = models.CharField(max_length=64)
+    objects = HistoryFeedManager()
+
+    def __str__(self):
+        return "<HistoryFeed>: {} (rp_song_id: {}) (id: {})".format(self.played_at, self.rp_song_id, self.id)
+
+
+class HistoryFeedTrackManager(models.Manager):
+    def refresh_songs(self, song_ids=None):
+        """
+        Replaces the feed tracks of the songs with the best scoring track available in each country.
+
+        :param song_ids: iterable of rphistory.Song ids, or None to refresh all songs
+        :return: count of feed tracks inserted
+        """
+        if song_ids is not None:
+            song_ids = list(song_ids)
+            if not song_ids:
+                return 0
+            where_clause = 'WHERE ta.rp_song_id = ANY(%s)'
+            params = [song_ids]
+        else:
+            where_clause = ''
+            params = []
+
+        table = self.model._meta.db_table
+        sql = '''
+            INSERT INTO {feed_track}
+                        (song_id, country, spotify_track_id, spotify_album_img_small_url, spotify_album_img_large_url)
+            SELECT DISTINCT ON (ta.rp_song_id, ta.country)
+                   ta.rp_song_id,
+                   ta.country,
+                   track.spotify_id,
+                   spot_album.img_medium_url,
+                   spot_album.img_large_url
+              FROM trackmap_trackavailability ta
+              JOIN trackmap_track track ON track.id = ta.track_id
+              JOIN trackmap_album spot_album ON spot_album.id = track.album_id
+             {where_clause}
+          ORDER BY ta.rp_song_id, ta.country, ta.score DESC, ta.id
+            '''.format(feed_track=table, where_clause=where_clause)
+
+        with connection.cursor() as cursor:
+            if song_ids is None:
+                cursor.execute('TRUNCATE {}'.format(table))
+            else:
+                cursor.execute('DELETE FROM {} WHERE song_id = ANY(%s)'.format(table), [song_ids])
+            cursor.execute(sql, params)
+            inserted = cursor.rowcount
+        # Tracks may also have been removed, so the cache is invalidated even if none were inserted.
+        invalidate_history_cache(True)
+        return inserted
+
+
+class HistoryFeedTrack(models.Model):
+    """
+    The Spotify track used for a song in the history feed of a country.
+    """
+    song = models.ForeignKey('rphistory.Song', related_name='+')
+    country = models.CharField(max_length=2)
+    spotify_track_id = models.CharField(max_length=120)
+    spotify_album_img_small_url = models.URLField(null=True)
+    spotify_album_img_large_url = models.URLField(null=True)
+    objects = HistoryFeedTrackManager()
+
+    class Meta:
+        unique_together = (('song', 'country'),)
+
+    def __str__(self):
+        return "<HistoryFeedTrack>: {} (song_id: {}) (spotify_track_id: {})".format(
+            self.country, self.song_id, self.spotify_track_id)
+
+
+# Columns of the history results.
+HISTORY_COLUMNS = (
+    'played_at', 'rp_song_id', 'title', 'artist_name', 'album_title', 'asin', 'spotify_track_id',
+    'spotify_album_img_small_url', 'spotify_album_img_large_url', 'country_match',
+)
+
+
+def history_sql(country, where_clause='TRUE', params=None, order_direction='DESC', limit=None):
+    """
+    Builds the query for the Radio Paradise song history from the history feed, with the Spotify track available
+    in the country for each song, if any.  If no track is available in the country, the track of the reference
+    country is given, with country_match false.
+
+    :param string country: two letter country code
+    :param where_clause: SQL condition on the feed (alias f)
+    :param params: parameters for where_clause
+    :param order_direction: 'ASC' or 'DESC': which end of the selected period the limit applies to
+    :param int limit: max number of results
+    :return: tuple (sql, params).  The results are ordered by played_at descending.
+    """
+    params = [country, REFERENCE_COUNTRY] + (params or [])
+
     sql = """
-    SELECT DISTINCT ON (played_at)
-      date_trunc('second', played_at_time) AS played_at,
-      rp_song_id,
-      title,
-      artist_name,
-      album_title,
-      asin,
-      spotify_track_id,
-      spotify_album_img_small_url,
-      spotify_album_img_large_url,
-      coalesce(country_match, FALSE) AS country_match
-     FROM (
-        SELECT * FROM (
-            SELECT h.played_at AS played_at_time,
-                   s.rp_song_id,
-                   COALESCE(s.corrected_title, s.title) AS title,
-                   artist.name AS artist_name,
-                   album.title AS album_title,
-                   album.asin,
-                   track.spotify_id AS spotify_track_id,
-                   spot_album.img_medium_url AS spotify_album_img_small_url,
-                   spot_album.img_large_url AS spotify_album_img_large_url,
-                   artist.id AS artist_id,
-                   ta.country = %s AS country_match
-             FROM rphistory_history h
-             JOIN rphistory_song s ON h.song_id = s.id
-             JOIN rphistory_artist_songs ras ON s.id = ras.song_id
-             JOIN rphistory_artist artist ON artist.id = ras.artist_id
-             JOIN rphistory_album album ON album.id = s.album_id
-             LEFT OUTER JOIN trackmap_trackavailability ta ON ta.rp_song_id = s.id AND (ta.country = %s OR ta.country = %s)
-             LEFT OUTER JOIN trackmap_track track ON track.id = ta.track_id
-             LEFT OUTER JOIN trackmap_album spot_album ON spot_album.id = track.album_id
-             WHERE {l2_where_clause}
-             {l2_order_by_clause}
-             {l2_limit_clause}
-         ) subq_l2
-         {l1_limit_clause}
-     ) subq_l1
-    ORDER BY played_at DESC, country_match DESC, artist_id DESC
+    SELECT {columns} FROM (
+        SELECT f.played_at,
+               f.rp_song_id,
+               f.title,
+               f.artist_name,
+               f.album_title,
+               f.asin,
+               CASE WHEN t.id IS NULL THEN ref.spotify_track_id ELSE t.spotify_track_id END
+                   AS spotify_track_id,
+               CASE WHEN t.id IS NULL THEN ref.spotify_album_img_small_url ELSE t.spotify_album_img_small_url END
+                   AS spotify_album_img_small_url,
+               CASE WHEN t.id IS NULL THEN ref.spotify_album_img_large_url ELSE t.spotify_album_img_large_url END
+                   AS spotify_album_img_large_url,
+               t.id IS NOT NULL AS country_match
+          FROM {feed} f
+          LEFT OUTER JOIN {feed_track} t ON t.song_id = f.song_id AND t.country = %s
+          LEFT OUTER JOIN {feed_track} ref ON ref.song_id = f.song_id AND ref.country = %s
+         WHERE {where_clause}
+      ORDER BY f.played_at {order_direction}
+         {limit_clause}
+    ) feed
+    ORDER BY played_at DESC
     """.format(
-        l2_where_clause=l2_where_clause,
-        l2_order_by_clause=l2_order_by_clause,
-        l2_limit_clause=l2_limit_clause,
-        l1_limit_clause=l1_limit_clause
+        columns=', '.join(HISTORY_COLUMNS),
+        feed=HistoryFeed._meta.db_table,
+        feed_track=HistoryFeedTrack._meta.db_table,
+        where_clause=where_clause,
+        order_direction=order_direction,
+        limit_clause='LIMIT {:d}'.format(limit) if limit is not None else '',
     )
-    pretty_print_json = 'true'
-    json_sql = "SELECT array_to_json(array_agg(row_to_json(t, {})), {})" \
+    return sql, params
+
+
+def history(country, pretty=False, **kwargs):
+    """
+    Gets the history (see history_sql) as a json array, built in one string by the database.
+
+    :param bool pretty: pretty print the json (this makes it about 40% larger)
+    :return: json string with array of results
+    """
+    sql, params = history_sql(country, **kwargs)
+    pretty_print_json = 'true' if pretty else 'false'
+    # Cast to text, as psycopg2 would otherwise decode the json into python objects.
+    json_sql = "SELECT array_to_json(array_agg(row_to_json(t, {})), {})::text" \
         " FROM (".format(pretty_print_json, pretty_print_json) + sql + ") t"
 
     cursor = connection.cursor()
@@ -72,7 +282,86 @@ def history(country,
     return result or '[]'
 
 
-def json_history_count_vector(country, base_time, count_vector):
+def iter_history(country, fetch_size=100, **kwargs):
+    """
+    Gets the history (see history_sql) as a compact json array, streamed in chunks.
+
+    The rows are read from a server-side cursor, fetch_size rows at a time, so that the first chunk is available
+    as soon as the database returns the first rows, and the whole result is never held in memory.
+
+    :return: generator of json strings, which together form the json array
+    """
+    sql, params = history_sql(country, **kwargs)
+    json_sql = "SELECT row_to_json(t)::text FROM (" + sql + ") t"
+
+    # A server-side (named) cursor must be used inside a transaction.
+    with transaction.atomic():
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(name='rest_history_{}'.format(uuid4().hex))
+        try:
+            cursor.execute(json_sql, params)
+            yield '['
+            separator = ''
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield separator + ','.join(row[0] for row in rows)
+                separator = ','
+            yield ']'
+        finally:
+            cursor.close()
+
+
+def history_page(country, before=None, after=None, limit=100):
+    """
+    Gets a page of the history, using keyset pagination over the (unique) played_at.
+
+    Only the rows of the page (plus one, to know whether there are more) are read, using the
+    played_at index, however far back in the history the page is.
+
+    :param string country: two letter country code
+    :param datetime before: get the plays before this time (the next older page)
+    :param datetime after: get the plays after this time (the next newer page)
+    :param int limit: page size
+    :return: tuple (list of result dicts, ordered by played_at descending,
+             bool: True if there are more plays in the direction of the page).  Without before and after,
+             the page with the latest plays is returned.
+    """
+    if after is not None:
+        where_clause = 'f.played_at > %s'
+        params = [after]
+        order_direction = 'ASC'
+    elif before is not None:
+        where_clause = 'f.played_at < %s'
+        params = [before]
+        order_direction = 'DESC'
+    else:
+        where_clause = 'TRUE'
+        params = []
+        order_direction = 'DESC'
+
+    sql, params = history_sql(
+        country, where_clause=where_clause, params=params, order_direction=order_direction, limit=limit + 1)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        columns = [column[0] for column in cursor.description]
+        results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    has_more = len(results) > limit
+    if has_more:
+        # Drop the extra row, which is the farthest in the direction of the page.
+        results = results[1:] if order_direction == 'ASC' else results[:-1]
+    return results, has_more
+
+
+def history_json(stream=False, pretty=False, **kwargs):
+    if stream:
+        return iter_history(**kwargs)
+    return history(pretty=pretty, **kwargs)
+
+
+def json_history_count_vector(country, base_time, count_vector, stream=False, pretty=False):
     """
     Gets the Radio Paradise song history as a json array, with the associated Spotify
     track for each song, if any.
@@ -83,35 +372,31 @@ def json_history_count_vector(country, base_time, count_vector):
     :param string country: two letter country code
     :param datetime base_time:
     :param int count_vector: positive/negative int: how many results to return and in which direction from start_time
+    :param bool stream: return a generator of json chunks (see iter_history) instead of a json string
+    :param bool pretty: pretty print the json (not when streaming)
     :return: json string with array of results
     """
     if count_vector < 0:
         comparator = '<='
-        l2_order_by_direction = 'DESC'
+        order_direction = 'DESC'
     else:
         comparator = '>='
-        l2_order_by_direction = 'ASC'
+        order_direction = 'ASC'
 
     count = min(400, abs(count_vector))
 
-    l2_where_clause = "h.played_at {} %s".format(comparator)
-    l2_order_clause = "ORDER BY played_at {}".format(l2_order_by_direction)
-    # The l2_limit is larger than count, to allow for possible duplicate values and songs that are not available
-    # in the region.
-    l2_limit_clause = "LIMIT {}".format(count * 2)
-    l1_limit_clause = "LIMIT {}".format(count)
-
-    return history(
+    return history_json(
+        stream=stream,
+        pretty=pretty,
         country=country,
-        l2_where_clause=l2_where_clause,
-        l2_order_by_clause=l2_order_clause,
-        l2_limit_clause=l2_limit_clause,
-        l2_params=[base_time],
-        l1_limit_clause=l1_limit_clause
+        where_clause="f.played_at {} %s".format(comparator),
+        params=[base_time],
+        order_direction=order_direction,
+        limit=count,
     )
 
 
-def json_history_date_period(country, time_start, time_end):
+def json_history_date_period(country, time_start, time_end, stream=False, pretty=False):
     """
     Gets the Radio Paradise song history as a json array, with the associated Spotify
     track for each song, if any.
@@ -119,18 +404,15 @@ def json_history_date_period(country, time_start, time_end):
     :param string country: two letter country code
     :param datetime time_start:
     :param datetime time_end:
+    :param bool stream: return a generator of json chunks (see iter_history) instead of a json string
+    :param bool pretty: pretty print the json (not when streaming)
     :return: json string with array of results
     """
-    # TODO cache with a key "country + time_start (minute precision) + time_end (minute precision)"
-    return history(
+    return history_json(
+        stream=stream,
+        pretty=pretty,
         country=country,
-        l2_where_clause="h.played_at BETWEEN %s AND %s",
-        l2_params=[time_start, time_end]
+        where_clause="f.played_at BETWEEN %s AND %s",
+        params=[time_start, time_end]
     )
 
-
-def last_24_hours(country):
-    pass
-    # TODO call history, cache the result.
-    # Update caller of history() to use this method when appropriate.
-    # Invalidate cache when new song arrives.
@@ -0,0 +1,20 @@
+from django.dispatch import receiver
+
+from rphistory.signals import plays_saved, songs_changed
+from trackmap.signals import song_tracks_changed
+from .models import HistoryFeed, HistoryFeedTrack
+
+
+@receiver(plays_saved)
+def add_plays_to_feed(sender, played_at_times, **kwargs):
+    HistoryFeed.objects.add_plays(played_at_times)
+
+
+@receiver(songs_changed)
+def refresh_feed_songs(sender, song_ids, **kwargs):
+    HistoryFeed.objects.refresh_songs(song_ids)
+
+
+@receiver(song_tracks_changed)
+def refresh_feed_tracks(sender, song_ids, **kwargs):
+    HistoryFeedTrack.objects.refresh_songs(song_ids)
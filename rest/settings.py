@@ -0,0 +1,11 @@
+from django.conf import settings
+
+# Cache alias used for caching the history JSON:
+REST_HISTORY_CACHE = getattr(settings, 'REST_HISTORY_CACHE', 'default')
+# Requested history periods are rounded to multiples of this many seconds, so that requests share cache entries:
+REST_HISTORY_BUCKET_SECONDS = getattr(settings, 'REST_HISTORY_BUCKET_SECONDS', 60)
+# Seconds to cache the history of periods that ended before the latest play; None caches them indefinitely.
+# Changes to the songs or Spotify tracks in the history feed invalidate all cached periods.
+REST_HISTORY_CLOSED_PERIOD_TTL = getattr(settings, 'REST_HISTORY_CLOSED_PERIOD_TTL', 60*60*24)
+# Seconds to cache the history of periods that include the latest play (these are also invalidated by new plays):
+REST_HISTORY_LIVE_PERIOD_TTL = getattr(settings, 'REST_HISTORY_LIVE_PERIOD_TTL', 60*5)
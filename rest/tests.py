@@ -1,3 +1,326 @@
-from django.test import TestCase
+import base64
+from datetime import datetime, timedelta
+import json
+from pytz import utc
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from rphistory.models import Album, Artist, History, Song
+from rphistory.radioparadise import save_songs_and_history, SongInfo
+from rphistory.signals import songs_changed
+from trackmap.models import Album as SpotifyAlbum, Track, TrackAvailability
+from trackmap.settings import COUNTRY_CODES
+from .history_cache import cached_history_date_period, history_cache
+from .models import HistoryFeed, HistoryFeedTrack, history_sql, json_history_count_vector, json_history_date_period
 
-# Create your tests here.
+
+class HistoryFeedTest(TestCase):
+    def setUp(self):
+        self.played_at = datetime(2016, 3, 1, 12, 0, tzinfo=utc)
+        save_songs_and_history([
+            SongInfo(time=self.played_at, id='1', title='Waiting', artist='Santana', album='Santana',
+                     album_asin='B0000062FJ', album_release_year=1969),
+            # Reported again a fraction of a second later:
+            SongInfo(time=self.played_at + timedelta(microseconds=120999), id='1', title='Waiting',
+                     artist='Santana', album='Santana', album_asin='B0000062FJ', album_release_year=1969),
+        ])
+
+    def test_plays_added_to_feed(self):
+        self.assertEqual(1, HistoryFeed.objects.count())
+        feed = HistoryFeed.objects.get()
+        self.assertEqual(self.played_at, feed.played_at)
+        self.assertEqual('Santana', feed.artist_name)
+
+    def test_history_from_feed(self):
+        data = json.loads(json_history_date_period(
+            'US', self.played_at - timedelta(hours=1), self.played_at + timedelta(hours=1)))
+        self.assertEqual(1, len(data))
+        self.assertEqual('Waiting', data[0]['title'])
+        self.assertIsNone(data[0]['spotify_track_id'])
+        self.assertFalse(data[0]['country_match'])
+
+        data = json.loads(json_history_count_vector('US', self.played_at, -10))
+        self.assertEqual(1, len(data))
+
+
+# A TransactionTestCase, as the cache is invalidated when the transaction that changed the history commits.
+class HistoryViewCacheTest(TransactionTestCase):
+    def setUp(self):
+        history_cache().clear()
+
+    def tearDown(self):
+        history_cache().clear()
+
+    def test_etag(self):
+        url = reverse('history', args=['US'])
+        # Not cached yet: streamed, and cached once it has been completely sent.
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.streaming)
+        self.assertEqual([], json.loads(b''.join(response.streaming_content).decode('utf-8')))
+
+        response = self.client.get(url)
+        self.assertFalse(response.streaming)
+        etag = response['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+
+        # A new play changes the last 24 hours.
+        save_songs_and_history([
+            SongInfo(time=datetime.now(utc) - timedelta(minutes=1), id='1', title='Waiting', artist='Santana',
+                     album='Santana', album_asin='B0000062FJ', album_release_year=1969)])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, len(json.loads(b''.join(response.streaming_content).decode('utf-8'))))
+
+    def test_etag_of_gzipped_response(self):
+        now = datetime.now(utc)
+        # Enough plays for the response to be compressed.
+        save_songs_and_history([
+            SongInfo(time=now - timedelta(minutes=5 * i), id=str(i), title='Song {}'.format(i), artist='Santana',
+                     album='Santana', album_asin='B0000062FJ', album_release_year=1969)
+            for i in range(1, 6)])
+        url = reverse('history', args=['US'])
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        b''.join(response.streaming_content)
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('gzip', response['Content-Encoding'])
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+
+    def cached_titles(self, time_start, time_end):
+        """
+        :return: tuple (True if the history was cached, list of titles)
+        """
+        etag, data = cached_history_date_period('US', time_start, time_end)
+        return etag is not None, [play['title'] for play in json.loads(data if etag else ''.join(data))]
+
+    def test_period_end_included(self):
+        played_at = datetime(2016, 3, 1, 12, 0, 30, tzinfo=utc)
+        save_songs_and_history([
+            SongInfo(time=played_at, id='1', title='Waiting', artist='Santana', album='Santana',
+                     album_asin='B0000062FJ', album_release_year=1969)])
+        self.assertEqual((False, ['Waiting']), self.cached_titles(
+            played_at - timedelta(hours=1), played_at + timedelta(seconds=10)))
+
+    def test_closed_period_invalidated_by_changed_song(self):
+        played_at = datetime(2016, 3, 1, 12, 0, tzinfo=utc)
+        save_songs_and_history([
+            SongInfo(time=played_at, id='1', title='Waitin', artist='Santana', album='Santana',
+                     album_asin='B0000062FJ', album_release_year=1969),
+            SongInfo(time=played_at + timedelta(hours=2), id='2', title='Evil Ways', artist='Santana',
+                     album='Santana', album_asin='B0000062FJ', album_release_year=1969)])
+        period = (played_at - timedelta(hours=1), played_at + timedelta(hours=1))
+        self.assertEqual((False, ['Waitin']), self.cached_titles(*period))
+        self.assertEqual((True, ['Waitin']), self.cached_titles(*period))
+
+        song = Song.objects.get(rp_song_id=1)
+        song.corrected_title = 'Waiting'
+        song.save()
+        songs_changed.send(sender=Song, song_ids=[song.id])
+        self.assertEqual((False, ['Waiting']), self.cached_titles(*period))
+
+
+class HistoryPagesTest(TestCase):
+    def setUp(self):
+        self.start = datetime(2016, 3, 1, 12, 0, tzinfo=utc)
+        save_songs_and_history([
+            SongInfo(time=self.start + timedelta(minutes=5 * i), id=str(i), title='Song {}'.format(i),
+                     artist='Santana', album='Santana', album_asin='B0000062FJ', album_release_year=1969)
+            for i in range(5)])
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.content.decode('utf-8'))
+        return data, [result['title'] for result in data['results']]
+
+    def test_paging(self):
+        data, titles = self.get(reverse('history_pages', args=['US']) + '?limit=2')
+        self.assertEqual(['Song 4', 'Song 3'], titles)
+        self.assertIsNone(data['previous'])
+
+        data, titles = self.get(data['next'])
+        self.assertEqual(['Song 2', 'Song 1'], titles)
+
+        data, titles = self.get(data['next'])
+        self.assertEqual(['Song 0'], titles)
+        self.assertIsNone(data['next'])
+
+        data, titles = self.get(data['previous'])
+        self.assertEqual(['Song 2', 'Song 1'], titles)
+
+        data, titles = self.get(data['previous'])
+        self.assertEqual(['Song 4', 'Song 3'], titles)
+        self.assertIsNone(data['previous'])
+        self.assertIsNotNone(data['next'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('history_pages', args=['US']) + '?cursor=invalid')
+        self.assertEqual(400, response.status_code)
+
+        out_of_range = base64.urlsafe_b64encode('b:{}'.format(10 ** 30).encode('ascii')).decode('ascii')
+        response = self.client.get(reverse('history_pages', args=['US']) + '?cursor=' + out_of_range)
+        self.assertEqual(400, response.status_code)
+
+
+class QueryPlanTest(TestCase):
+    """
+    Checks with EXPLAIN (ANALYZE, BUFFERS) that the history queries find their rows through indexes,
+    instead of reading the large tables.
+
+    The planner is free to choose its plan, so the dataset has the proportions of the production data:
+    a track is available in each of sixty Spotify markets, which makes reading the track availabilities
+    or feed tracks of a whole market cost more than looking up the rows of the query through an index.
+    A plan fails the check when it reads one of the large tables sequentially, or with an index scan that
+    has no index condition, unless it is an ordered scan stopped by a limit.
+    """
+    SONG_COUNT = 5000
+    PLAY_COUNT = 50000
+    COUNTRY_COUNT = 60
+    LARGE_TABLES = tuple(model._meta.db_table for model in (
+        History, Song, Track, TrackAvailability, HistoryFeed, HistoryFeedTrack))
+    INDEX_SCANS = ('Index Scan', 'Index Only Scan')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.first_play = datetime(2015, 1, 1, tzinfo=utc)
+        countries = ['CH', 'US'] + [code for code in COUNTRY_CODES if code not in ('CH', 'US')]
+        countries = countries[:cls.COUNTRY_COUNT]
+        album_count = cls.SONG_COUNT // 10
+        with connection.cursor() as cursor:
+            for sql, params in [
+                ("INSERT INTO {album} (title, asin, release_year)"
+                 " SELECT 'Album ' || i, 'ASIN' || i, 1970 + i %% 40 FROM generate_series(1, %s) i",
+                 [album_count]),
+                ("INSERT INTO {artist} (name) SELECT 'Artist ' || i FROM generate_series(1, %s) i",
+                 [album_count]),
+                ("INSERT INTO {song} (title, rp_song_id, album_id)"
+                 " SELECT 'Song ' || i, i, a.id FROM generate_series(1, %s) i"
+                 " JOIN {album} a ON a.asin = 'ASIN' || (i %% %s + 1)",
+                 [cls.SONG_COUNT, album_count]),
+                ("INSERT INTO {artist_songs} (artist_id, song_id) SELECT ar.id, s.id FROM {song} s"
+                 " JOIN {artist} ar ON ar.name = 'Artist ' || (s.rp_song_id %% %s + 1)",
+                 [album_count]),
+                ("INSERT INTO {history} (song_id, played_at)"
+                 " SELECT s.id, %s + i * interval '4 minutes' FROM generate_series(1, %s) i"
+                 " JOIN {song} s ON s.rp_song_id = i %% %s + 1",
+                 [cls.first_play, cls.PLAY_COUNT, cls.SONG_COUNT]),
+                ("INSERT INTO {spotify_album} (spotify_id, title)"
+                 " SELECT 'album' || i, 'Album ' || i FROM generate_series(1, %s) i",
+                 [album_count]),
+                # Two of every three songs have a track.
+                ("INSERT INTO {track} (spotify_id, title, album_id, artist, artist_id, many_artists)"
+                 " SELECT 'track' || s.rp_song_id, s.title, a.id, 'Artist', 'artist', false FROM {song} s"
+                 " JOIN {spotify_album} a ON a.spotify_id = 'album' || (s.rp_song_id %% %s + 1)"
+                 " WHERE s.rp_song_id %% 3 <> 0",
+                 [album_count]),
+                # The tracks are available in every country, except for every other one in the US.
+                ("INSERT INTO {track_availability} (track_id, rp_song_id, country, score)"
+                 " SELECT t.id, s.id, c.country, 100 FROM {song} s"
+                 " JOIN {track} t ON t.spotify_id = 'track' || s.rp_song_id"
+                 " CROSS JOIN unnest(%s) AS c(country)"
+                 " WHERE c.country <> 'US' OR s.rp_song_id %% 2 = 0",
+                 [countries]),
+            ]:
+                cursor.execute(sql.format(
+                    album=Album._meta.db_table,
+                    artist=Artist._meta.db_table,
+                    song=Song._meta.db_table,
+                    artist_songs=Artist.songs.through._meta.db_table,
+                    history=History._meta.db_table,
+                    spotify_album=SpotifyAlbum._meta.db_table,
+                    track=Track._meta.db_table,
+                    track_availability=TrackAvailability._meta.db_table,
+                ), params)
+
+        HistoryFeed.objects.rebuild()
+        HistoryFeedTrack.objects.refresh_songs()
+        with connection.cursor() as cursor:
+            for table in cls.LARGE_TABLES:
+                cursor.execute('ANALYZE {}'.format(connection.ops.quote_name(table)))
+
+    def explain(self, sql, params):
+        """
+        :return: the root node of the executed plan of the query
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]['Plan']
+
+    def plan_problems(self, node, limited=False):
+        """
+        :param limited: whether the node's rows are read by a Limit node, which stops reading them early
+        :return: generator of descriptions of the large table reads in the plan node and its children
+        """
+        table = node.get('Relation Name')
+        if table in self.LARGE_TABLES:
+            node_type = node['Node Type']
+            if node_type == 'Seq Scan':
+                yield 'sequential scan of {}'.format(table)
+            elif node_type in self.INDEX_SCANS and 'Index Cond' not in node and not limited:
+                yield '{} of {} with {} has no index condition'.format(node_type, table, node['Index Name'])
+        limited = limited or node['Node Type'] == 'Limit'
+        for child in node.get('Plans', []):
+            for problem in self.plan_problems(child, limited):
+                yield problem
+
+    def scan_types(self, node, table):
+        """
+        :return: generator of the node types of the scans of the table in the plan node and its children
+        """
+        if node.get('Relation Name') == table:
+            yield node['Node Type']
+        for child in node.get('Plans', []):
+            for node_type in self.scan_types(child, table):
+                yield node_type
+
+    def describe(self, node, depth=0):
+        """
+        :return: generator of indented lines summarizing the plan node and its children
+        """
+        details = [node['Node Type']]
+        for key in ('Relation Name', 'Index Name', 'Index Cond', 'Filter', 'Rows Removed by Filter',
+                    'Actual Rows', 'Actual Loops'):
+            if key in node:
+                details.append('{}: {}'.format(key, node[key]))
+        details.append('Buffers: {}'.format(node['Shared Hit Blocks'] + node['Shared Read Blocks']))
+        yield '  ' * depth + ', '.join(details)
+        for child in node.get('Plans', []):
+            for line in self.describe(child, depth + 1):
+                yield line
+
+    def assertIndexedPlan(self, sql, params):
+        """
+        :return: the root node of the executed plan of the query
+        """
+        plan = self.explain(sql, params)
+        problems = list(self.plan_problems(plan))
+        self.assertEqual([], problems, "Plan:\n{}".format('\n'.join(self.describe(plan))))
+        return plan
+
+    def test_available_tracks(self):
+        for sql, params in [
+            Track.objects.available_tracks_sql('US'),
+            Track.objects.available_tracks_sql('US', start_time=self.first_play + timedelta(days=30)),
+        ]:
+            plan = self.assertIndexedPlan(sql, params)
+            # The (rp_song, country, track) index answers the availability lookup of each play by itself.
+            self.assertEqual(
+                ['Index Only Scan'], list(self.scan_types(plan, TrackAvailability._meta.db_table)),
+                "Plan:\n{}".format('\n'.join(self.describe(plan))))
+
+    def test_history(self):
+        middle = self.first_play + timedelta(minutes=4 * self.PLAY_COUNT // 2)
+        self.assertIndexedPlan(*history_sql(
+            'US', where_clause='f.played_at BETWEEN %s AND %s', params=[middle, middle + timedelta(days=1)]))
+        self.assertIndexedPlan(*history_sql(
+            'US', where_clause='f.played_at <= %s', params=[middle], order_direction='DESC', limit=400))
+        self.assertIndexedPlan(*history_sql(
+            'US', where_clause='f.played_at >= %s', params=[middle], order_direction='ASC', limit=400))
@@ -5,5 +5,6 @@ from .views import UnmatchedSongList
 
 urlpatterns = [
     url(r'^history/(?P<country>[A-Z]{2})/$', views.history, name='history'),
+    url(r'^history/(?P<country>[A-Z]{2})/pages/$', views.history_pages, name='history_pages'),
     url(r'^unmatched/(?P<country>[A-Z]{2})/$', UnmatchedSongList.as_view(), name='unmatched'),
 ]
\ No newline at end of file
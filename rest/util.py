@@ -1,8 +1,14 @@
+import base64
 import pytz
 import datetime
 from django.utils.dateparse import parse_datetime
 
 
+CURSOR_BEFORE = 'b'
+CURSOR_AFTER = 'a'
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
 def utc_now():
     return datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
 
@@ -37,3 +43,35 @@ def get_valid_period(start_time=None, end_time=None):
         return start_time, start_time + day
     else:
         return end_time - day, end_time
+
+
+def encode_cursor(direction, played_at):
+    """
+    Encodes an opaque pagination cursor.
+
+    :param direction: CURSOR_BEFORE (for older plays) or CURSOR_AFTER (for newer plays)
+    :param datetime played_at: play time of the boundary row
+    :return: string
+    """
+    microseconds = (played_at - EPOCH) // datetime.timedelta(microseconds=1)
+    value = '{}:{}'.format(direction, microseconds)
+    return base64.urlsafe_b64encode(value.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor made by encode_cursor.
+
+    :return: tuple (direction, played_at)
+    :raises ValueError: if the cursor is not valid
+    """
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')
+        direction, microseconds = value.split(':')
+        # Any datetime is within the range of a Postgresql timestamp; larger values raise an OverflowError.
+        played_at = EPOCH + datetime.timedelta(microseconds=int(microseconds))
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("Invalid cursor")
+    if direction not in (CURSOR_BEFORE, CURSOR_AFTER):
+        raise ValueError("Invalid cursor")
+    return direction, played_at
@@ -3,19 +3,39 @@ from rest_framework.decorators import api_view
 from rest_framework.exceptions import ParseError, ValidationError
 from rest_framework.response import Response
 from rest_framework import generics
+from rest_framework.utils.urls import replace_query_param
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
 from django.utils.dateparse import parse_datetime
+from django.views.decorators.gzip import gzip_page
 
 from rphistory.models import Song
-from .models import json_history_count_vector, json_history_date_period
+from .history_cache import cached_history_date_period, last_24_hours
+from .models import history_page, json_history_count_vector, json_history_date_period
 from .serializers import UnmatchedSongsSerializer
-from .util import utc_now, get_valid_period
+from .util import utc_now, get_valid_period, encode_cursor, decode_cursor, CURSOR_AFTER, CURSOR_BEFORE
 
 
+JSON_CONTENT_TYPE = 'application/json'
+# End of the etag of a response compressed by Django's gzip middleware (e.g. "etag;gzip"):
+GZIP_ETAG_SUFFIX = ';gzip"'
+HISTORY_PAGE_SIZE = 100
+HISTORY_MAX_PAGE_SIZE = 400
+
+
+@gzip_page
 @api_view()
 def history(request, country):
+    """
+    Responds with the history as a json array.  The json is compact, unless the pretty=true parameter is given,
+    and is gzipped if the client accepts it.
+
+    Cached history is sent with an ETag.  Other history is streamed from the database as it is read.
+    """
+    pretty = request.query_params.get('pretty') == 'true'
     base_time, count_vector = extract_time_vector(request)
     if base_time:
-        data = json_history_count_vector(country, base_time, count_vector)
+        etag = None
+        data = json_history_count_vector(country, base_time, count_vector, stream=not pretty, pretty=pretty)
     else:
         start_time = extract_datetime_param(request, 'start_time')
         end_time = extract_datetime_param(request, 'end_time')
@@ -24,11 +44,72 @@ def history(request, country):
         except ValueError as e:
             raise ValidationError({'error': str(e)})
 
-        data = json_history_date_period(country, start, end)
+        if pretty:
+            etag = None
+            data = json_history_date_period(country, start, end, pretty=True)
+        elif start_time is None and end_time is None:
+            etag, data = last_24_hours(country)
+        else:
+            etag, data = cached_history_date_period(country, start, end)
+
+    if isinstance(data, str):
+        if etag is not None and etag_matches(request, etag):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(data, content_type=JSON_CONTENT_TYPE)
+        if etag is not None:
+            response['ETag'] = etag
+        return response
+
+    return StreamingHttpResponse(data, content_type=JSON_CONTENT_TYPE)
+
+
+@gzip_page
+@api_view()
+def history_pages(request, country):
+    """
+    Responds with a page of the history, newest plays first, with the urls of the next (older)
+    and previous (newer) pages:
+
+        {"next": url or null, "previous": url or null, "results": [...]}
+
+    The first page has the latest plays.  Pages are selected by an opaque cursor, so that paging
+    through the history never repeats or skips plays, and each page is read directly from the index.
+    """
+    limit = request.query_params.get('limit')
+    try:
+        limit = min(HISTORY_MAX_PAGE_SIZE, max(1, int(limit))) if limit is not None else HISTORY_PAGE_SIZE
+    except ValueError:
+        raise ValidationError({'error': 'limit parameter should be a positive base 10 integer'})
+
+    direction, boundary = None, None
+    cursor = request.query_params.get('cursor')
+    if cursor is not None:
+        try:
+            direction, boundary = decode_cursor(cursor)
+        except ValueError as e:
+            raise ValidationError({'error': str(e)})
+
+    results, has_more = history_page(
+        country,
+        before=boundary if direction == CURSOR_BEFORE else None,
+        after=boundary if direction == CURSOR_AFTER else None,
+        limit=limit)
+
+    url = request.build_absolute_uri()
 
-    response = Response(data)
-    response['Content-Length'] = len(data)
-    return Response(data)
+    def page_url(cursor_direction, played_at):
+        return replace_query_param(url, 'cursor', encode_cursor(cursor_direction, played_at))
+
+    # There are older plays if this page was reached going forward (to newer plays), or if the query says so.
+    next_url = None
+    if has_more or direction == CURSOR_AFTER:
+        next_url = page_url(CURSOR_BEFORE, results[-1]['played_at'] if results else boundary)
+    previous_url = None
+    if (has_more and direction == CURSOR_AFTER) or direction == CURSOR_BEFORE:
+        previous_url = page_url(CURSOR_AFTER, results[0]['played_at'] if results else boundary)
+
+    return Response({'next': next_url, 'previous': previous_url, 'results': results})
 
 
 class UnmatchedSongList(generics.ListAPIView):
@@ -55,6 +136,29 @@ class UnmatchedSongList(generics.ListAPIView):
         return Response(serializer.data)
 
 
+def etag_matches(request, etag):
+    """
+    Compares the etags weakly, and ignores the ";gzip" suffix that Django's gzip middleware adds to the etag
+    of compressed responses (newer Django versions make it a weak etag instead).
+
+    :return: True if the request's If-None-Match header matches etag
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    for value in if_none_match.split(','):
+        value = value.strip()
+        if value == '*':
+            return True
+        if value.startswith('W/'):
+            value = value[2:]
+        if value.endswith(GZIP_ETAG_SUFFIX):
+            value = value[:-len(GZIP_ETAG_SUFFIX)] + '"'
+        if value == etag:
+            return True
+    return False
+
+
 def extract_time_vector(request):
     """
     Extract base time and directional count from request, if present.
@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+import threading
+
+from django.core.cache import caches
+
+from spotify.scheduler import RequestScheduler
+from rphistory.models import Album, Song
+from rphistory.signals import songs_changed
+from rphistory.radioparadise import AsinLookupError, get_info_from_asin
+from .settings import (
+    RP_ASIN_CACHE, RP_ASIN_CACHE_TTL, RP_ASIN_NEGATIVE_CACHE_TTL, RP_ASIN_LOOKUP_WORKERS, RP_ASIN_REQUESTS_PER_SECOND)
+
+
+# Cached in place of an AsinInfo when no info could be found for an asin.
+NOT_FOUND = 'not-found'
+
+
+log = getLogger(__name__)
+
+_scheduler_lock = threading.Lock()
+_scheduler = None
+
+
+def asin_cache():
+    return caches[RP_ASIN_CACHE]
+
+
+def asin_cache_key(asin):
+    return 'rphistory:asin:' + asin
+
+
+def asin_scheduler():
+    """
+    :return: the RequestScheduler that limits the rate of the Amazon requests made by this process
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler(rate=RP_ASIN_REQUESTS_PER_SECOND, burst=1)
+        return _scheduler
+
+
+def cached_asin_info(asin):
+    """
+    Gets the info for the asin from the cache, or from Amazon if it is not cached.
+
+    Found results are cached, and so are definitive not found results, for a shorter time.  Lookups that failed
+    for a reason that may be temporary (e.g. a network error) are not cached, so that they are retried.
+
+    :return: AsinInfo, or None if no info could be found
+    """
+    if not asin:
+        return None
+
+    key = asin_cache_key(asin)
+    cached = asin_cache().get(key)
+    if cached == NOT_FOUND:
+        return None
+    if cached is not None:
+        return cached
+
+    asin_scheduler().acquire()
+    try:
+        info = get_info_from_asin(asin, raise_errors=True)
+    except AsinLookupError as e:
+        log.warn("cached_asin_info: lookup of asin {} failed, not caching the result: {}".format(asin, e))
+        return None
+    if info is None:
+        asin_cache().set(key, NOT_FOUND, RP_ASIN_NEGATIVE_CACHE_TTL)
+    else:
+        asin_cache().set(key, info, RP_ASIN_CACHE_TTL)
+    return info
+
+
+def lookup_asins(asins, workers=RP_ASIN_LOOKUP_WORKERS):
+    """
+    Gets the info for several asins, looking up the ones that are not cached concurrently.
+
+    :return: dict of asin => AsinInfo or None
+    """
+    asins = list(set(asins))
+    if workers <= 1 or len(asins) <= 1:
+        return {asin: cached_asin_info(asin) for asin in asins}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(asins, executor.map(cached_asin_info, asins)))
+
+
+def fill_missing_album_titles(limit=None, workers=RP_ASIN_LOOKUP_WORKERS):
+    """
+    Sets the title of albums that were saved without a title, using the info found for their asin.
+
+    :param int limit: max number of albums to look up, or None for all
+    :return: tuple (count of albums looked up, count of albums for which a title was found)
+    """
+    albums = Album.objects.filter(title='').exclude(asin='').order_by('-id')
+    if limit is not None:
+        albums = albums[:limit]
+    albums = list(albums)
+
+    infos = lookup_asins([album.asin for album in albums], workers=workers)
+    updated = 0
+    for album in albums:
+        info = infos.get(album.asin)
+        if info and info.title:
+            # Only update albums that still have no title.
+            if Album.objects.filter(id=album.id, title='').update(title=info.title):
+                updated += 1
+                songs_changed.send(
+                    sender=Song, song_ids=list(Song.objects.filter(album=album).values_list('id', flat=True)))
+    return len(albums), updated
@@ -0,0 +1,72 @@
+import os
+import time
+import tracemalloc
+from django.core.management.base import BaseCommand, CommandError
+from rphistory.radioparadise import ASIN_PAGE_PARSER, fetch_asin_page, parse_asin_page
+
+
+def measure(func, *args, **kwargs):
+    """
+    :return: tuple (result, seconds, peak memory allocated in bytes)
+    """
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+class Command(BaseCommand):
+    help = ('Compares the parse time and peak memory of the targeted and the full parsing of saved '
+            'Amazon product pages (fixtures)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('pages', nargs='*',
+                            help='Saved product page files, named <asin>.html')
+        parser.add_argument('--save', dest='save_asins', nargs='+', default=[],
+                            help='Fetch the product pages of these asins, and save them as <asin>.html in the '
+                                 'current directory, for use as fixtures')
+        parser.add_argument('--repeat', dest='repeat', nargs='?', type=int, default=3,
+                            help='Parse each page this many times, and report the fastest time (default: 3)')
+
+    def handle(self, *args, **options):
+        for asin in options['save_asins']:
+            page = fetch_asin_page(asin)
+            if page is None:
+                raise CommandError("Could not fetch the page for asin {}".format(asin))
+            with open(asin + '.html', 'wb') as f:
+                f.write(page)
+            self.stdout.write("Saved {}.html".format(asin))
+
+        if not options['pages']:
+            return
+
+        self.stdout.write("Parser: {}".format(ASIN_PAGE_PARSER))
+        repeat = max(1, options['repeat'])
+        totals = {True: [0.0, 0], False: [0.0, 0]}
+        for file_name in options['pages']:
+            asin = os.path.splitext(os.path.basename(file_name))[0]
+            with open(file_name, 'rb') as f:
+                page = f.read()
+
+            results = {}
+            for targeted in (False, True):
+                runs = [measure(parse_asin_page, asin, page, targeted=targeted) for _ in range(repeat)]
+                info = runs[0][0]
+                seconds = min(run[1] for run in runs)
+                peak = max(run[2] for run in runs)
+                results[targeted] = info
+                totals[targeted][0] += seconds
+                totals[targeted][1] = max(totals[targeted][1], peak)
+                self.stdout.write("{} ({} KB) {}: {:.1f} ms, peak memory {:.0f} KB".format(
+                    file_name, len(page) // 1024, 'targeted' if targeted else 'full', seconds * 1000, peak / 1024))
+
+            if results[True] != results[False]:
+                self.stdout.write("  Results differ: full: {}, targeted: {}".format(results[False], results[True]))
+
+        self.stdout.write("Total: full {:.1f} ms (peak {:.0f} KB), targeted {:.1f} ms (peak {:.0f} KB)".format(
+            totals[False][0] * 1000, totals[False][1] / 1024, totals[True][0] * 1000, totals[True][1] / 1024))
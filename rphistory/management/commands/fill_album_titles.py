@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from rphistory.asin import fill_missing_album_titles
+from rphistory.settings import RP_ASIN_LOOKUP_WORKERS
+
+
+class Command(BaseCommand):
+    help = 'Looks up the titles of albums that were loaded without a title, using their asin'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', dest='limit', nargs='?', type=int, default=None,
+                            help='Only look up the <limit> most recently added albums without a title')
+        parser.add_argument('--workers', dest='workers', nargs='?', type=int, default=RP_ASIN_LOOKUP_WORKERS,
+                            help='Number of concurrent lookups (default: {})'.format(RP_ASIN_LOOKUP_WORKERS))
+
+    def handle(self, *args, **options):
+        looked_up, updated = fill_missing_album_titles(limit=options['limit'], workers=options['workers'])
+        self.stdout.write("Looked up {} albums without a title, found titles for {}".format(looked_up, updated))
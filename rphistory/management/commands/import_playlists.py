@@ -0,0 +1,121 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import glob
+from itertools import islice
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from rphistory.radioparadise import parse_playlist_file, save_songs_and_history
+from rphistory.models import History
+from trackmap.models import SongMappingQueue
+
+
+# Number of files parsed ahead of the files being saved, per worker process:
+FILES_PARSED_AHEAD_PER_PROCESS = 2
+
+
+def playlist_files(paths):
+    """
+    :param paths: file names, directory names (all *.xml files in the directory are used) or glob patterns
+    :return: sorted list of file names, without duplicates
+    """
+    file_names = set()
+    for path in paths:
+        if os.path.isdir(path):
+            file_names.update(glob.glob(os.path.join(path, '*.xml')))
+        elif os.path.isfile(path):
+            file_names.add(path)
+        else:
+            matches = glob.glob(path)
+            if not matches:
+                raise CommandError("No playlist files found for {}".format(path))
+            file_names.update(name for name in matches if os.path.isfile(name))
+    return sorted(file_names)
+
+
+class Command(BaseCommand):
+    help = 'Imports archived Radio Paradise playlist files into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+',
+                            help='Playlist files, directories containing playlist (*.xml) files, or glob patterns '
+                                 '(quoted, e.g. "archive/2016-*.xml")')
+        parser.add_argument('--processes', dest='processes', nargs='?', type=int, default=os.cpu_count(),
+                            help='Number of worker processes used to parse the files (default: number of CPUs)')
+        parser.add_argument('--batch-size', dest='batch_size', nargs='?', type=int, default=2000,
+                            help='Save up to <batch-size> songs at a time (default: 2000)')
+        parser.add_argument('--fill-gaps', dest='fill_gaps', action='store_true', default=False,
+                            help='Also import songs played before the latest song already in the database.  '
+                                 'Songs that are already in the database are reported as failures.')
+        parser.add_argument('--map-queue', dest='map_queue', action='store_true', default=False,
+                            help='Add the new songs to the queue of songs to be mapped by map_queued_songs')
+
+    def handle(self, *args, **options):
+        file_names = playlist_files(options['paths'])
+        batch_size = max(1, options['batch_size'])
+        processes = max(1, options['processes'] or 1)
+
+        min_time = None
+        if not options['fill_gaps']:
+            latest_song = History.objects.all().order_by('-played_at').first()
+            if latest_song:
+                min_time = latest_song.played_at
+
+        self.stdout.write("Importing {} playlist files using {} processes".format(len(file_names), processes))
+
+        previous_file_times = set()
+        pending = []
+        new_song_ids = []
+        failures = []
+        parsed_count = 0
+        duplicate_count = 0
+        loaded_count = 0
+        start = time.time()
+
+        # The worker processes must not share the database connection of this process.
+        connection.close()
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            # Only a few files per process are parsed ahead of saving, so that the memory used does not grow
+            # with the number of files.
+            remaining_file_names = iter(file_names)
+            futures = deque(
+                executor.submit(parse_playlist_file, file_name, min_time)
+                for file_name in islice(remaining_file_names, processes * FILES_PARSED_AHEAD_PER_PROCESS))
+            file_number = 0
+            while futures:
+                songs = futures.popleft().result()
+                for file_name in islice(remaining_file_names, 1):
+                    futures.append(executor.submit(parse_playlist_file, file_name, min_time))
+                file_number += 1
+
+                parsed_count += len(songs)
+                # The same plays are contained in neighbouring archive files when the files overlap.  Only the
+                # times of the previous file are kept, so that the memory used does not grow with the archive size;
+                # any other duplicates are left out by the ON CONFLICT insert of the history, and reported as failures.
+                file_times = set()
+                for song in songs:
+                    if song.time in previous_file_times or song.time in file_times:
+                        duplicate_count += 1
+                    else:
+                        pending.append(song)
+                    file_times.add(song.time)
+                previous_file_times = file_times
+
+                while len(pending) >= batch_size or (pending and not futures):
+                    batch, pending = pending[:batch_size], pending[batch_size:]
+                    loaded_count += save_songs_and_history(
+                        batch, new_song_ids=new_song_ids, failures=failures, batch_size=batch_size)
+                    elapsed = time.time() - start
+                    self.stdout.write(
+                        "{}/{} files: {} songs parsed, {} duplicates skipped, {} loaded, {} failed "
+                        "({:.0f} songs/second)".format(
+                            file_number, len(file_names), parsed_count, duplicate_count, loaded_count,
+                            len(failures), parsed_count / elapsed if elapsed else 0))
+
+        self.stdout.write("Imported {} song play histories from {} files in {:.1f} seconds, {} new songs".format(
+            loaded_count, len(file_names), time.time() - start, len(new_song_ids)))
+
+        if new_song_ids and options['map_queue']:
+            queued = SongMappingQueue.objects.enqueue(new_song_ids)
+            self.stdout.write("Queued {} new songs for mapping".format(queued))
@@ -1,8 +1,11 @@
+from collections import Counter
 from django.core.management.base import BaseCommand, CommandError
 from rphistory.radioparadise import (
-    get_playlist_from_url, get_playlist_from_file, playlist_to_python, save_songs_and_history)
+    get_playlist_from_url, iter_playlist_songs, playlist_to_python, save_songs_and_history)
+from rphistory.asin import fill_missing_album_titles
 from rphistory.models import History
-from rphistory.settings import RP_PLAYLIST_BASE
+from rphistory.settings import RP_PLAYLIST_BASE, RP_ASIN_LOAD_PLAYLIST_LOOKUPS
+from trackmap.models import SongMappingQueue
 
 
 class Command(BaseCommand):
@@ -14,6 +17,26 @@ class Command(BaseCommand):
             dest='playlist',
             default=None,
             help='Specify which playlist from https://www.radioparadise.com/xml to use (example: --playlist now_4.xml)')
+        parser.add_argument(
+            '--file',
+            dest='file_name',
+            default=None,
+            help='Load the playlist from a local (e.g. archived) playlist file instead.  The file is parsed '
+                 'incrementally, so it can be of any size')
+        parser.add_argument(
+            '--no-map-queue',
+            dest='no_map_queue',
+            action='store_true',
+            default=False,
+            help='Do not add new songs to the queue of songs to be mapped by the map_queued_songs command')
+        parser.add_argument(
+            '--album-titles',
+            dest='album_titles',
+            action='store_true',
+            default=False,
+            help='Also look up the titles of up to RP_ASIN_LOAD_PLAYLIST_LOOKUPS albums that were loaded without '
+                 'a title.  By default they are left to the fill_album_titles command, so that loading the '
+                 'playlist does not wait for Amazon')
 
     def handle(self, *args, **options):
 
@@ -28,10 +51,38 @@ class Command(BaseCommand):
         else:
             min_time = None
 
+        if options['file_name']:
+            self.save_songs(iter_playlist_songs(options['file_name'], min_time=min_time), options)
+            return
+
         latest_playlist = get_playlist_from_url(url)
         if latest_playlist:
-            songs = playlist_to_python(latest_playlist, min_time=min_time)
-            loaded = save_songs_and_history(songs)
-            self.stdout.write("Loaded {}/{} new song play histories".format(loaded, len(songs)))
+            self.save_songs(playlist_to_python(latest_playlist, min_time=min_time), options)
         else:
             self.stdout.write("Playlist file unchanged, nothing to do.")
+
+    def save_songs(self, songs, options):
+        """
+        :param iterable songs: SongInfo tuples
+        """
+        new_song_ids = []
+        song_count = Counter()
+
+        def counted(songs):
+            for song in songs:
+                song_count['songs'] += 1
+                yield song
+
+        loaded = save_songs_and_history(counted(songs), new_song_ids=new_song_ids)
+        self.stdout.write("Loaded {}/{} new song play histories".format(loaded, song_count['songs']))
+
+        # Look up missing album titles before queueing the songs, so that they are mapped with the album title.
+        if loaded and options['album_titles']:
+            looked_up, updated = fill_missing_album_titles(limit=RP_ASIN_LOAD_PLAYLIST_LOOKUPS)
+            if looked_up:
+                self.stdout.write("Looked up {} albums without a title, found titles for {}".format(
+                    looked_up, updated))
+
+        if new_song_ids and not options['no_map_queue']:
+            queued = SongMappingQueue.objects.enqueue(new_song_ids)
+            self.stdout.write("Queued {} new songs for mapping".format(queued))
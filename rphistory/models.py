@@ -1,7 +1,43 @@
-from django.db import models
+from django.db import connection, models
 from django.apps import apps
 
 
+def insert_ignoring_conflicts(model, rows, conflict_fields, returning=()):
+    """
+    Inserts the rows in one statement, ignoring rows that conflict with existing rows.
+
+    Uses Postgresql's INSERT ... ON CONFLICT DO NOTHING (Postgresql 9.5+).
+
+    :param model: model class (may be an automatically created many-to-many through model)
+    :param rows: list of dicts of column name => value.  All dicts must have the same keys.
+    :param conflict_fields: column names of the unique constraint for which conflicts are ignored
+    :param returning: column names to return for the inserted rows
+    :return: list of tuples of the returning column values of the rows that were inserted
+    """
+    if not rows:
+        return []
+
+    columns = list(rows[0])
+    qn = connection.ops.quote_name
+    sql = '''
+        INSERT INTO {table} ({columns})
+             VALUES {values}
+        ON CONFLICT ({conflict_columns}) DO NOTHING
+        {returning}
+        '''.format(
+        table=qn(model._meta.db_table),
+        columns=', '.join(qn(column) for column in columns),
+        values=', '.join(['({})'.format(', '.join(['%s'] * len(columns)))] * len(rows)),
+        conflict_columns=', '.join(qn(column) for column in conflict_fields),
+        returning='RETURNING ' + ', '.join(qn(column) for column in returning) if returning else '',
+    )
+    params = [row[column] for row in rows for column in columns]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall() if returning else []
+
+
 class Artist(models.Model):
     name = models.CharField(max_length=255, null=False, unique=True)
     songs = models.ManyToManyField('Song', related_name='artists')
@@ -1,5 +1,7 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from datetime import datetime
+from io import BytesIO
+from itertools import islice
 from logging import getLogger
 import zlib
 from pytz import utc
@@ -10,11 +12,17 @@ from xml.etree import ElementTree
 
 from django.core.cache import caches
 from django.db import transaction
-from django.db.utils import IntegrityError
+from django.db.utils import DatabaseError
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+try:
+    import lxml
+    ASIN_PAGE_PARSER = 'lxml'
+except ImportError:
+    ASIN_PAGE_PARSER = 'html.parser'
 
-from rphistory.models import History, Song, Album, Artist
+from rphistory.models import History, Song, Album, Artist, insert_ignoring_conflicts
+from rphistory.signals import plays_saved, songs_changed
 from .settings import RP_PLAYLIST_URL, RP_CACHE
 
 
@@ -35,6 +43,16 @@ AsinInfo = namedtuple('AsinInfo', 'asin title authors tracks')
 # * album_release_year: year album was released
 SongInfo = namedtuple('SongInfo', 'time id title artist album album_asin album_release_year')
 
+# Ids of the elements of an Amazon product page that contain the info extracted by parse_asin_page:
+# the product title, the byline with the authors, and the non-mp3 and mp3 sample track listings.
+ASIN_PAGE_REGION_IDS = ('productTitle', 'bylineInfo', 'byline', 'musicTracksFeature', 'albumTrackList')
+
+# HTTP status codes with which Amazon answers that there is no product page for an asin:
+ASIN_NOT_FOUND_STATUS_CODES = (404, 410)
+
+# Contained in the page Amazon answers with instead of the product page, when it suspects automated requests:
+ASIN_CAPTCHA_MARKER = b'/errors/validateCaptcha'
+
 
 log = getLogger(__name__)
 
@@ -47,68 +65,206 @@ def playlist_to_python(xml_string, min_time=None):
     """
     :param xml_string: playlist xml string
     :param min_time: UTC datetime. If provided, only songs with a timestamp greater than this will be returned.
+    :return: list of SongInfo tuples, ordered by time
+    """
+    if isinstance(xml_string, str):
+        xml_string = xml_string.encode('utf-8')
+    return sorted(iter_playlist_songs(BytesIO(xml_string), min_time=min_time), key=lambda s: s.time)
+
+
+def iter_playlist_songs(source, min_time=None):
+    """
+    Parses the playlist incrementally, yielding the songs in the order they appear in the playlist.
+
+    Each song element is cleared once it has been parsed, so that memory use does not depend on the
+    size of the playlist.
+
+    :param source: file name or binary file object of the playlist xml
+    :param min_time: UTC datetime. If provided, only songs with a timestamp greater than this will be yielded.
+    :return: generator of SongInfo tuples
     """
-    songs = []
-    playlist = ElementTree.fromstring(xml_string)
-    for song in playlist:
-        time = datetime.utcfromtimestamp(float(song.find('timestamp').text)).replace(tzinfo=utc)
+    events = ElementTree.iterparse(source, events=('start', 'end'))
+    _, playlist = next(events)
+    for event, element in events:
+        if event != 'end' or element.tag != 'song':
+            continue
+
+        fields = {child.tag: child.text for child in element}
+        # Remove the parsed song (and any previous, non-song elements) from the playlist element.
+        playlist.clear()
+
+        time = datetime.utcfromtimestamp(float(fields['timestamp'])).replace(tzinfo=utc)
         if min_time and time <= min_time:
             continue
 
-        songs.append(SongInfo(
+        yield SongInfo(
             time=time,
-            id=song.find('songid').text,
-            title=song.find('title').text,
-            artist=song.find('artist').text,
-            album=song.find('album').text,
-            album_asin=song.find('asin').text,
-            album_release_year=int(song.find('release_date').text),
-        ))
+            id=fields['songid'],
+            title=fields['title'],
+            artist=fields['artist'],
+            album=fields['album'],
+            album_asin=fields['asin'],
+            album_release_year=int(fields['release_date']),
+        )
 
-    sorted_songs = sorted(songs, key=lambda s: s.time)
-    return sorted_songs
+
+def parse_playlist_file(file_name, min_time=None):
+    """
+    Parses a playlist file.  This is a module level function so that it can be run in worker processes.
+
+    :return: list of SongInfo tuples, in the order they appear in the file
+    """
+    return list(iter_playlist_songs(file_name, min_time=min_time))
 
 
-def save_songs_and_history(songs):
+def save_songs_and_history(songs, new_song_ids=None, failures=None, batch_size=500):
     """
+    Saves the songs, their albums and artists, and their play history.
 
-    :param iterable songs: SongInfo tuples
+    The songs are saved in batches, using a few set-based queries per batch.  If a batch can not be saved
+    (e.g. because of invalid data), its songs are saved one at a time, so that failures are reported per song.
+
+    :param iterable songs: SongInfo tuples.  Only one batch of songs is read from the iterable at a time.
+    :param list new_song_ids: if provided, the ids of newly created Song objects are appended to this list
+    :param list failures: if provided, (SongInfo, error message) tuples are appended for songs that failed
+    :param int batch_size: max number of songs saved per batch
     :return: count of songs successfully processed
     """
+    songs = iter(songs)
     loaded = 0
-    for song in songs:
+    while True:
+        batch = list(islice(songs, batch_size))
+        if not batch:
+            break
         try:
-            with transaction.atomic():
-                album_title = song.album
-                if not album_title:
-                    log.info(
-                        "save_songs_and_history: album title missing: [title: {}, asin: {}, release_year: {}]".format(
-                            song.album, song.album_asin, song.album_release_year))
-                    asin_info = get_info_from_asin(song.album_asin)
-                    if asin_info:
-                        album_title = asin_info.title
-                    else:
-                        album_title = ''
-                        log.info(
-                            "save_songs_and_history: album title not found from asin:"
-                            "[title: {}, asin: {}, release_year: {}]".format(
-                                song.album, song.album_asin, song.album_release_year))
-                album, _ = Album.objects.get_or_create(
-                    asin=song.album_asin,
-                    defaults={'title': album_title, 'release_year': song.album_release_year})
-                artist, _ = Artist.objects.get_or_create(name=song.artist)
-                song_object, _ = Song.objects.get_or_create(
-                    rp_song_id=song.id, defaults={'title': song.title, 'album': album})
-                song_object.artists.add(artist)
-                History.objects.create(song=song_object, played_at=song.time)
-                loaded += 1
-        except IntegrityError as e:
-            log.warn("save_songs_and_history failed to process song {}: {}".format(song, e))
-            continue
+            loaded += save_songs_and_history_batch(batch, new_song_ids=new_song_ids, failures=failures)
+        except (DatabaseError, ValueError) as e:
+            log.warn("save_songs_and_history: saving batch of {} songs failed, saving songs one at a time: {}".format(
+                len(batch), e))
+            for song in batch:
+                if save_song_and_history(song, new_song_ids=new_song_ids, failures=failures):
+                    loaded += 1
+
+    return loaded
+
+
+def save_songs_and_history_batch(songs, new_song_ids=None, failures=None):
+    """
+    Saves the songs in one transaction, with a constant number of queries.
+
+    Songs whose play time is already in the history are reported as failures.  Other errors abort the whole batch.
+
+    :param list songs: SongInfo tuples
+    :param list new_song_ids: if provided, the ids of newly created Song objects are appended to this list
+    :param list failures: if provided, (SongInfo, error message) tuples are appended for songs that failed
+    :return: count of songs successfully processed
+    """
+    if not songs:
+        return 0
+
+    # As with get_or_create, the first song seen for an album / song determines the values used to create it.
+    album_rows = OrderedDict()
+    song_rows = OrderedDict()
+    for song in songs:
+        # Albums without a title are saved with an empty title, which is looked up later by
+        # fill_missing_album_titles (see rphistory.asin), to keep Amazon out of the transaction.
+        album_rows.setdefault(song.album_asin, {
+            'asin': song.album_asin, 'title': song.album or '', 'release_year': song.album_release_year})
+        song_rows.setdefault(int(song.id), {
+            'rp_song_id': int(song.id), 'title': song.title, 'album_asin': song.album_asin})
+    artist_names = list(OrderedDict.fromkeys(song.artist for song in songs))
+
+    existing_asins = set(Album.objects.filter(asin__in=list(album_rows)).values_list('asin', flat=True))
+    new_album_rows = [row for asin, row in album_rows.items() if asin not in existing_asins]
+
+    with transaction.atomic():
+        insert_ignoring_conflicts(Album, new_album_rows, ['asin'])
+        album_ids = dict(Album.objects.filter(asin__in=list(album_rows)).values_list('asin', 'id'))
+
+        insert_ignoring_conflicts(Artist, [{'name': name} for name in artist_names], ['name'])
+        artist_ids = dict(Artist.objects.filter(name__in=artist_names).values_list('name', 'id'))
+
+        created_song_ids = [row[0] for row in insert_ignoring_conflicts(
+            Song,
+            [{'rp_song_id': rp_song_id, 'title': row['title'], 'album_id': album_ids[row['album_asin']]}
+             for rp_song_id, row in song_rows.items()],
+            ['rp_song_id'],
+            returning=['id'])]
+        song_ids = dict(Song.objects.filter(rp_song_id__in=list(song_rows)).values_list('rp_song_id', 'id'))
+
+        artist_song_pairs = OrderedDict.fromkeys((artist_ids[song.artist], song_ids[int(song.id)]) for song in songs)
+        linked_song_ids = {row[0] for row in insert_ignoring_conflicts(
+            Artist.songs.through,
+            [{'artist_id': artist_id, 'song_id': song_id} for artist_id, song_id in artist_song_pairs],
+            ['artist_id', 'song_id'],
+            returning=['song_id'])}
+
+        history_rows = OrderedDict()
+        for song in songs:
+            history_rows.setdefault(song.time, {'song_id': song_ids[int(song.id)], 'played_at': song.time})
+        inserted_times = {row[0] for row in insert_ignoring_conflicts(
+            History, list(history_rows.values()), ['played_at'], returning=['played_at'])}
+
+        # Existing songs that got another artist may be shown with a different artist.
+        changed_song_ids = linked_song_ids.difference(created_song_ids)
+        if changed_song_ids:
+            songs_changed.send(sender=Song, song_ids=list(changed_song_ids))
+        if inserted_times:
+            plays_saved.send(sender=History, played_at_times=list(inserted_times))
+
+    if new_song_ids is not None:
+        new_song_ids.extend(created_song_ids)
+
+    loaded = 0
+    for song in songs:
+        if song.time in inserted_times:
+            # A play time is only counted once, even if it appears several times in the songs.
+            inserted_times.remove(song.time)
+            loaded += 1
+        else:
+            message = "a song was already played at {}".format(song.time)
+            log.warn("save_songs_and_history failed to process song {}: {}".format(song, message))
+            if failures is not None:
+                failures.append((song, message))
 
     return loaded
 
 
+def save_song_and_history(song, new_song_ids=None, failures=None):
+    """
+    Saves one song, its album and artist, and its play history, in one transaction.
+
+    :param SongInfo song: song to save
+    :param list new_song_ids: if provided, the id of the Song object is appended to this list if it is created
+    :param list failures: if provided, a (SongInfo, error message) tuple is appended if the song failed
+    :return: True if the song was successfully processed
+    """
+    try:
+        with transaction.atomic():
+            album = Album.objects.filter(asin=song.album_asin).first()
+            if album is None:
+                album, _ = Album.objects.get_or_create(
+                    asin=song.album_asin,
+                    defaults={'title': song.album or '', 'release_year': song.album_release_year})
+            artist, _ = Artist.objects.get_or_create(name=song.artist)
+            song_object, song_created = Song.objects.get_or_create(
+                rp_song_id=song.id, defaults={'title': song.title, 'album': album})
+            song_object.artists.add(artist)
+            History.objects.create(song=song_object, played_at=song.time)
+            if not song_created:
+                songs_changed.send(sender=Song, song_ids=[song_object.id])
+            plays_saved.send(sender=History, played_at_times=[song.time])
+    except (DatabaseError, ValueError) as e:
+        log.warn("save_songs_and_history failed to process song {}: {}".format(song, e))
+        if failures is not None:
+            failures.append((song, str(e)))
+        return False
+
+    if song_created and new_song_ids is not None:
+        new_song_ids.append(song_object.id)
+    return True
+
+
 def get_playlist_from_file(file_name):
     with open(file_name, 'r') as f:
         text = f.read()
@@ -153,10 +309,39 @@ def get_response_if_modified(url, etag=None):
             raise
 
 
-def get_info_from_asin(asin):
+class AsinLookupError(Exception):
+    """
+    Raised when the info for an asin could not be looked up for a reason that may be temporary, e.g. a network
+    error, or Amazon refusing the request.
+    """
+    pass
+
+
+def get_info_from_asin(asin, raise_errors=False):
+    """
+    :param bool raise_errors: raise AsinLookupError if the lookup failed for a reason that may be temporary,
+                              instead of returning None
+    :return: AsinInfo, or None if no info was found
+    """
     if not asin:
         return None
 
+    page = fetch_asin_page(asin, raise_errors=raise_errors)
+    if page is None:
+        return None
+
+    info = parse_asin_page(asin, page)
+    if info is None and raise_errors and ASIN_CAPTCHA_MARKER in page:
+        raise AsinLookupError("Amazon answered with a captcha page for asin {}".format(asin))
+    return info
+
+
+def fetch_asin_page(asin, raise_errors=False):
+    """
+    :param bool raise_errors: raise AsinLookupError if the page could not be fetched, unless Amazon answered
+                              that it does not exist
+    :return: bytes: the Amazon product page html, or None if it could not be fetched
+    """
     # alternative: url = "http://www.amazon.com/exec/obidos/ASIN/{}".format(asin)
     url = "http://www.amazon.com/exec/obidos/tg/detail/-/{}".format(asin)
     request = Request(url)
@@ -166,14 +351,31 @@ def get_info_from_asin(asin):
         response = urlopen(request, timeout=10)
         data = response.read()
         if response.getheader('Content-Encoding') == 'gzip':
-            page = zlib.decompress(data, 16+zlib.MAX_WBITS)
+            return zlib.decompress(data, 16+zlib.MAX_WBITS)
         else:
-            page = data
+            return data
     except (HTTPError, URLError, timeout) as err:
         log.warn("get_info_from_asin: Error opening asin url: {}".format(err))
+        if raise_errors and getattr(err, 'code', None) not in ASIN_NOT_FOUND_STATUS_CODES:
+            raise AsinLookupError(str(err))
         return None
 
-    soup = BeautifulSoup(page)
+
+def parse_asin_page(asin, page, targeted=True):
+    """
+    Extracts the album info from an Amazon product page.
+
+    By default, only the regions of the page containing the product title, the authors and the track
+    listings are built into a tree, which is much faster and uses much less memory than parsing the whole page.
+
+    :param bytes page: product page html
+    :param bool targeted: only parse the needed regions of the page (False parses the whole page)
+    :return: AsinInfo, or None if no product title was found
+    """
+    if targeted:
+        soup = BeautifulSoup(page, ASIN_PAGE_PARSER, parse_only=SoupStrainer(id=list(ASIN_PAGE_REGION_IDS)))
+    else:
+        soup = BeautifulSoup(page, ASIN_PAGE_PARSER)
 
     try:
         title = soup.find(id='productTitle').string
@@ -3,3 +3,11 @@ from django.conf import settings
 RP_PLAYLIST_BASE = getattr(settings, 'RP_PLAYLIST_BASE', 'https://www.radioparadise.com/xml/')
 RP_PLAYLIST_URL = getattr(settings, 'RP_PLAYLIST_URL', 'https://www.radioparadise.com/xml/playlist.xml')
 RP_CACHE = getattr(settings, 'RP_CACHE', 'default')
+RP_ASIN_CACHE = getattr(settings, 'RP_ASIN_CACHE', RP_CACHE)
+# Found album infos rarely change; failed lookups are retried after a shorter time:
+RP_ASIN_CACHE_TTL = getattr(settings, 'RP_ASIN_CACHE_TTL', 60*60*24*30)
+RP_ASIN_NEGATIVE_CACHE_TTL = getattr(settings, 'RP_ASIN_NEGATIVE_CACHE_TTL', 60*60*24)
+RP_ASIN_LOOKUP_WORKERS = getattr(settings, 'RP_ASIN_LOOKUP_WORKERS', 4)
+RP_ASIN_REQUESTS_PER_SECOND = getattr(settings, 'RP_ASIN_REQUESTS_PER_SECOND', 1.0)
+# Max number of untitled albums whose titles are looked up by load_playlist --album-titles after loading songs:
+RP_ASIN_LOAD_PLAYLIST_LOOKUPS = getattr(settings, 'RP_ASIN_LOAD_PLAYLIST_LOOKUPS', 10)
@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+
+# Sent (inside the saving transaction) after plays were added to the History.
+plays_saved = Signal(providing_args=['played_at_times'])
+
+# Sent after the title, album or artists of existing songs changed.
+songs_changed = Signal(providing_args=['song_ids'])
@@ -1,8 +1,16 @@
+from datetime import datetime
+from io import BytesIO
+from unittest import mock
+from urllib.error import HTTPError, URLError
+from pytz import utc
 from django.test import TestCase
-from rphistory.radioparadise import rphistory_cache, get_playlist_from_url
+from rphistory.models import History, Song
+from rphistory.radioparadise import (
+    rphistory_cache, get_playlist_from_url, iter_playlist_songs, playlist_to_python, save_songs_and_history, SongInfo)
 from rphistory.settings import RP_PLAYLIST_BASE
 
-from rphistory.radioparadise import get_info_from_asin
+from rphistory.radioparadise import get_info_from_asin, parse_asin_page
+from rphistory.asin import asin_cache, asin_cache_key, cached_asin_info, NOT_FOUND
 
 
 class AsinFetch(TestCase):
@@ -14,6 +22,50 @@ class AsinFetch(TestCase):
         self.assertEqual(expected_title, info.title)
 
 
+class AsinParse(TestCase):
+    page = (
+        '<html><body><div><p>Other content</p></div>'
+        '<h1><span id="productTitle">Santana</span></h1>'
+        '<div id="bylineInfo"><span class="author notFaded"><a href="#">Santana</a></span></div>'
+        '<div id="musicTracksFeature"><div class="content"><table>'
+        '<tr><td> Waiting </td></tr><tr><td>Evil Ways</td></tr></table></div></div>'
+        '</body></html>').encode('utf-8')
+
+    def test_targeted_parse(self):
+        info = parse_asin_page('B0000062FJ', self.page)
+        self.assertEqual('Santana', info.title)
+        self.assertEqual(['Santana'], info.authors)
+        self.assertEqual(['Waiting', 'Evil Ways'], info.tracks)
+        self.assertEqual(parse_asin_page('B0000062FJ', self.page, targeted=False), info)
+
+
+class AsinCache(TestCase):
+    def tearDown(self):
+        asin_cache().clear()
+
+    def test_not_found_is_cached(self):
+        asin = 'B000NOTFOUND'
+        asin_cache().set(asin_cache_key(asin), NOT_FOUND)
+        self.assertIsNone(cached_asin_info(asin))
+
+    def test_failed_lookup_is_not_cached(self):
+        asin = 'B000NOTFOUND'
+        with mock.patch('rphistory.radioparadise.urlopen', side_effect=URLError('timed out')):
+            self.assertIsNone(cached_asin_info(asin))
+        self.assertIsNone(asin_cache().get(asin_cache_key(asin)))
+
+        not_found = HTTPError('http://www.amazon.com/', 404, 'Not Found', {}, None)
+        with mock.patch('rphistory.radioparadise.urlopen', side_effect=not_found):
+            self.assertIsNone(cached_asin_info(asin))
+        self.assertEqual(NOT_FOUND, asin_cache().get(asin_cache_key(asin)))
+
+    def test_found_is_cached(self):
+        asin = 'B0000062FJ'
+        info = cached_asin_info(asin)
+        self.assertIsNotNone(info)
+        self.assertEqual(info, asin_cache().get(asin_cache_key(asin)))
+
+
 class PlaylistFetch(TestCase):
     def tearDown(self):
         rphistory_cache().clear()
@@ -33,3 +85,51 @@ class PlaylistFetch(TestCase):
         cache.clear()
         data = get_playlist_from_url(url)
         self.assertIsNotNone(data)
+
+
+class PlaylistParse(TestCase):
+    playlist = (
+        '<playlist>' +
+        ''.join('<song><timestamp>{}</timestamp><songid>{}</songid><title>Title {}</title><artist>Artist</artist>'
+                '<album>Album</album><asin>B0000062FJ</asin><release_date>1969</release_date></song>'.format(
+                    1456833600 - i * 300, i, i) for i in range(5)) +
+        '</playlist>')
+
+    def test_min_time_applied_while_parsing(self):
+        min_time = datetime.utcfromtimestamp(1456833600 - 3 * 300).replace(tzinfo=utc)
+        songs = list(iter_playlist_songs(BytesIO(self.playlist.encode('utf-8')), min_time=min_time))
+        self.assertEqual(['0', '1', '2'], [song.id for song in songs])
+        self.assertEqual('Title 0', songs[0].title)
+        self.assertEqual(1969, songs[0].album_release_year)
+
+    def test_playlist_to_python_sorted_by_time(self):
+        songs = playlist_to_python(self.playlist)
+        self.assertEqual(['4', '3', '2', '1', '0'], [song.id for song in songs])
+
+
+class SaveSongs(TestCase):
+    def song(self, minute, rp_song_id, title):
+        return SongInfo(
+            time=datetime(2016, 3, 1, 12, minute, tzinfo=utc), id=str(rp_song_id), title=title, artist='Santana',
+            album='Santana', album_asin='B0000062FJ', album_release_year=1969)
+
+    def test_batch_save(self):
+        songs = [self.song(0, 1, 'Waiting'), self.song(5, 2, 'Evil Ways'), self.song(10, 1, 'Waiting')]
+        new_song_ids = []
+        failures = []
+        loaded = save_songs_and_history(songs, new_song_ids=new_song_ids, failures=failures)
+        self.assertEqual(3, loaded)
+        self.assertEqual([], failures)
+        self.assertEqual(2, len(new_song_ids))
+        self.assertEqual(3, History.objects.count())
+        self.assertEqual(1, Song.objects.get(rp_song_id=1).artists.count())
+
+    def test_already_played_is_reported(self):
+        save_songs_and_history([self.song(0, 1, 'Waiting')])
+        songs = [self.song(0, 1, 'Waiting'), self.song(5, 2, 'Evil Ways')]
+        new_song_ids = []
+        failures = []
+        loaded = save_songs_and_history(songs, new_song_ids=new_song_ids, failures=failures)
+        self.assertEqual(1, loaded)
+        self.assertEqual([songs[0]], [song for song, _ in failures])
+        self.assertEqual([Song.objects.get(rp_song_id=2).id], new_song_ids)
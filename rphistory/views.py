@@ -9,8 +9,10 @@ from django.http import HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_POST
+from spotify.scheduler import PRIORITY_INTERACTIVE, request_priority
 from trackmap import trackmap
 from .models import Song
+from .signals import songs_changed
 from trackmap.models import TrackSearchHistory
 
 
@@ -128,7 +130,9 @@ def manually_checked(request, song_id):
 def retry(request, song_id):
     song = get_object_or_404(Song, pk=song_id)
 
-    call_command('map_tracks', force=True, rp_song_id=song.rp_song_id)
+    # Don't use cached responses, the point of retrying is to see if Spotify has something new.
+    with request_priority(PRIORITY_INTERACTIVE):
+        call_command('map_tracks', force=True, rp_song_id=song.rp_song_id, no_response_cache=True)
 
     return redirect_or_text_response(request)
 
@@ -144,8 +148,10 @@ def correct_title(request, song_id):
 
     song.corrected_title = correct_title.strip()
     song.save()
+    songs_changed.send(sender=Song, song_ids=[song.id])
 
-    call_command('map_tracks', force=True, rp_song_id=song.rp_song_id)
+    with request_priority(PRIORITY_INTERACTIVE):
+        call_command('map_tracks', force=True, rp_song_id=song.rp_song_id)
 
     return redirect_or_text_response(request)
 
@@ -162,6 +168,7 @@ def set_isrc(request, song_id):
     song.isrc = isrc
     song.save()
 
-    call_command('map_tracks', force=True, rp_song_id=song.rp_song_id)
+    with request_priority(PRIORITY_INTERACTIVE):
+        call_command('map_tracks', force=True, rp_song_id=song.rp_song_id)
 
     return redirect_or_text_response(request)
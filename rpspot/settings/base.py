@@ -128,6 +128,20 @@ CACHES = {
         'LOCATION': FS_CACHE_ROOT('trackmap_cache')
 
     },
+    'rest_history': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': FS_CACHE_ROOT('rest_history_cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    'spotify_responses': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': FS_CACHE_ROOT('spotify_responses_cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 50000,
+        },
+    },
 }
 
 REST_FRAMEWORK = {
@@ -139,7 +153,10 @@ SESSION_FILE_PATH = env.str('SESSION_FILE_PATH', gettempdir())
 
 RP_CACHE = 'rphistory'
 
+REST_HISTORY_CACHE = 'rest_history'
+
 SPOTIFY_CACHE = 'default'
+SPOTIFY_RESPONSE_CACHE = 'spotify_responses'
 SPOTIFY_CLIENT_ID = env.str('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = env.str('SPOTIFY_CLIENT_SECRET')
 
@@ -0,0 +1,98 @@
+from collections import Counter
+from hashlib import sha1
+import json
+import threading
+from django.core.cache import caches
+
+from .settings import SPOTIFY_RESPONSE_CACHE, SPOTIFY_SEARCH_CACHE_TTL, SPOTIFY_ALBUM_CACHE_TTL
+
+
+def normalize_query(q):
+    """
+    Normalizes a search query, so that queries which Spotify treats the same way share a cache entry.
+    """
+    return ' '.join(q.lower().split())
+
+
+def search_cache_key(q, type, limit, offset, market):
+    key_data = json.dumps([normalize_query(q), type, limit, offset, market])
+    return 'spotify:search:' + sha1(key_data.encode('utf-8')).hexdigest()
+
+
+def album_cache_key(album_id):
+    return 'spotify:album:' + album_id
+
+
+class CachedSpotify(object):
+    """
+    Wraps a spotipy client, caching the responses of search() and albums() calls.
+
+    Search responses are cached by normalized query, type, limit, offset and market.  Albums are cached
+    individually by id, so that an albums() call only requests the albums that are not yet cached.
+
+    The size of the cache is bounded by the MAX_ENTRIES option of the cache backend.
+
+    All other attributes are delegated to the wrapped client.
+    """
+
+    def __init__(self, client, cache_alias=SPOTIFY_RESPONSE_CACHE,
+                 search_ttl=SPOTIFY_SEARCH_CACHE_TTL, album_ttl=SPOTIFY_ALBUM_CACHE_TTL):
+        self.client = client
+        self.cache_alias = cache_alias
+        self.search_ttl = search_ttl
+        self.album_ttl = album_ttl
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    @property
+    def cache(self):
+        # Django cache objects are not thread safe; caches[] returns a separate instance per thread.
+        return caches[self.cache_alias]
+
+    def count(self, name, value=1):
+        with self._stats_lock:
+            self.stats[name] += value
+
+    def search(self, q, limit=10, offset=0, type='track', market=None):
+        key = search_cache_key(q, type, limit, offset, market)
+        result = self.cache.get(key)
+        if result is not None:
+            self.count('search_hits')
+            return result
+
+        self.count('search_misses')
+        result = self.client.search(q=q, limit=limit, offset=offset, type=type, market=market)
+        self.cache.set(key, result, self.search_ttl)
+        return result
+
+    def albums(self, albums):
+        """
+        :param albums: list of album ids
+        :return: dict like the one returned by spotipy: {'albums': [album, ...]}, in the same order as the ids
+        """
+        keys = {album_id: album_cache_key(album_id) for album_id in albums}
+        cached = self.cache.get_many(keys.values())
+        missing = [album_id for album_id in albums if keys[album_id] not in cached]
+        self.count('album_hits', len(albums) - len(missing))
+        self.count('album_misses', len(missing))
+
+        if missing:
+            fetched = {}
+            for album_id, album in zip(missing, self.client.albums(missing)['albums']):
+                # Spotify returns null for unknown album ids; these are not cached.
+                if album is not None:
+                    fetched[keys[album_id]] = album
+            self.cache.set_many(fetched, self.album_ttl)
+            cached.update(fetched)
+
+        return {'albums': [cached.get(keys[album_id]) for album_id in albums]}
+
+    def stats_summary(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return "search: {} hits / {} misses, albums: {} hits / {} misses".format(
+            stats.get('search_hits', 0), stats.get('search_misses', 0),
+            stats.get('album_hits', 0), stats.get('album_misses', 0))
@@ -0,0 +1,183 @@
+from contextlib import contextmanager
+from functools import wraps
+from logging import getLogger
+import random
+import threading
+import time
+import requests
+
+from .settings import (
+    SPOTIFY_REQUESTS_PER_SECOND, SPOTIFY_REQUEST_BURST, SPOTIFY_MAX_RETRIES, SPOTIFY_BACKOFF_BASE, SPOTIFY_BACKOFF_MAX)
+
+
+# Request priorities; lower values are served first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BULK)
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+log = getLogger(__name__)
+
+_priority = threading.local()
+
+
+def current_priority():
+    return getattr(_priority, 'value', PRIORITY_BULK)
+
+
+@contextmanager
+def request_priority(priority):
+    """
+    Context manager that sets the priority of the Spotify requests made by the current thread.
+
+    Example: ``with request_priority(PRIORITY_INTERACTIVE): call_command('map_tracks', ...)``
+    """
+    previous = current_priority()
+    _priority.value = priority
+    try:
+        yield
+    finally:
+        _priority.value = previous
+
+
+def with_current_priority(func):
+    """
+    Wraps func so that, when it is called in another thread, it uses the request priority of the calling thread.
+    """
+    priority = current_priority()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with request_priority(priority):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def backoff_delay(attempt, base=SPOTIFY_BACKOFF_BASE, cap=SPOTIFY_BACKOFF_MAX):
+    """
+    Exponential backoff with full jitter.
+
+    :param int attempt: 0 for the first retry
+    :return: float: seconds to wait
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after_delay(response):
+    """
+    :return: float: seconds given in the response's Retry-After header, or None if not present / not parseable
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class RequestScheduler(object):
+    """
+    Token bucket rate limiter, shared by all threads of a process.
+
+    Threads waiting with a higher priority are given tokens before threads with a lower priority.
+    When Spotify responds with a 429, pause() stops all requests until the Retry-After period is over.
+    """
+
+    def __init__(self, rate=SPOTIFY_REQUESTS_PER_SECOND, burst=SPOTIFY_REQUEST_BURST):
+        self.rate = float(rate)
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = {priority: 0 for priority in PRIORITIES}
+        self.condition = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _higher_priority_waiting(self, priority):
+        return any(self.waiting[p] for p in PRIORITIES if p < priority)
+
+    def acquire(self, priority=PRIORITY_BULK):
+        """
+        Blocks until a request may be made.
+        """
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now < self.paused_until:
+                        timeout = self.paused_until - now
+                    elif self.tokens < 1:
+                        timeout = (1 - self.tokens) / self.rate
+                    elif self._higher_priority_waiting(priority):
+                        # Let the more urgent request take the token; check again when it has.
+                        timeout = 1 / self.rate
+                    else:
+                        self.tokens -= 1
+                        return
+                    self.condition.wait(timeout)
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def pause(self, seconds):
+        """
+        Stops all requests for the given number of seconds.
+        """
+        with self.condition:
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = 0.0
+            self.updated = now
+            self.condition.notify_all()
+
+
+class ScheduledSession(requests.Session):
+    """
+    requests session that passes every request through a RequestScheduler.
+
+    Requests that fail with a 429, a 5xx status or a connection error are retried, after waiting for the
+    Retry-After period (if given), or otherwise a jittered exponential backoff delay.
+    """
+
+    def __init__(self, scheduler, max_retries=SPOTIFY_MAX_RETRIES):
+        super().__init__()
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+
+    def request(self, method, url, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.scheduler.acquire(current_priority())
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                log.warning("Spotify request {} {} failed ({}), retrying in {:.1f}s".format(method, url, e, delay))
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                return response
+
+            delay = retry_after_delay(response)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            log.warning("Spotify request {} {} got status {}, retrying in {:.1f}s".format(
+                method, url, response.status_code, delay))
+            if response.status_code == 429:
+                # The rate limit applies to all requests, not just this one.
+                self.scheduler.pause(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
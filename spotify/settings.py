@@ -0,0 +1,20 @@
+from django.conf import settings
+
+# Number of host connection pools kept by the shared HTTP session:
+SPOTIFY_HTTP_POOL_CONNECTIONS = getattr(settings, 'SPOTIFY_HTTP_POOL_CONNECTIONS', 4)
+# Max number of keep-alive connections kept per host (should be at least the number of concurrent request threads):
+SPOTIFY_HTTP_POOL_MAXSIZE = getattr(settings, 'SPOTIFY_HTTP_POOL_MAXSIZE', 32)
+
+# Cache alias used for caching Spotify search and album responses:
+SPOTIFY_RESPONSE_CACHE = getattr(settings, 'SPOTIFY_RESPONSE_CACHE', 'spotify_responses')
+# Seconds to cache search responses and album lookups for:
+SPOTIFY_SEARCH_CACHE_TTL = getattr(settings, 'SPOTIFY_SEARCH_CACHE_TTL', 60*60*24)
+SPOTIFY_ALBUM_CACHE_TTL = getattr(settings, 'SPOTIFY_ALBUM_CACHE_TTL', 60*60*24*7)
+
+# Request rate allowed by our Spotify quota (per process), and how many requests may be made in a burst:
+SPOTIFY_REQUESTS_PER_SECOND = getattr(settings, 'SPOTIFY_REQUESTS_PER_SECOND', 10.0)
+SPOTIFY_REQUEST_BURST = getattr(settings, 'SPOTIFY_REQUEST_BURST', 10)
+# How often a request is retried after a 429, 5xx or connection error, and the backoff limits in seconds:
+SPOTIFY_MAX_RETRIES = getattr(settings, 'SPOTIFY_MAX_RETRIES', 5)
+SPOTIFY_BACKOFF_BASE = getattr(settings, 'SPOTIFY_BACKOFF_BASE', 1.0)
+SPOTIFY_BACKOFF_MAX = getattr(settings, 'SPOTIFY_BACKOFF_MAX', 60.0)
@@ -1,19 +1,98 @@
 from base64 import b64encode
 from collections import namedtuple
+import threading
+import time
 from django.conf import settings
 from django.core.cache import caches
-import requests
+from requests.adapters import HTTPAdapter
 import spotipy
 
+from .response_cache import CachedSpotify
+from .scheduler import RequestScheduler, ScheduledSession
+from .settings import SPOTIFY_HTTP_POOL_CONNECTIONS, SPOTIFY_HTTP_POOL_MAXSIZE
+
 
 CLIENT_CREDENTIALS_CACHE_KEY = 'spotify_client_credentials'
 CLIENT_CREDENTIALS_URL = 'https://accounts.spotify.com/api/token'
 
 TrackResult = namedtuple('TrackResult', 'id album_match available_markets')
 
+_shared_lock = threading.Lock()
+_shared_session = None
+_shared_client = None
+_shared_cached_client = None
+
+
+class ClientCredentialsManager(object):
+    """
+    Supplies spotipy with a valid client credentials token for each request.
+
+    The token is kept in memory for a short while, and is otherwise read from the spotify cache, which
+    expires it shortly before Spotify does.  This way a long-lived client never uses an expired token.
+    """
+
+    # Seconds to keep the token in memory before checking the cache again.  This must be less than the
+    # margin subtracted from the token lifetime when caching it in client_credentials_token().
+    memory_ttl = 30
+
+    def __init__(self):
+        self._token = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def get_access_token(self):
+        with self._lock:
+            now = time.time()
+            if self._token is None or now - self._checked_at > self.memory_ttl:
+                self._token = client_credentials_token()
+                self._checked_at = now
+            return self._token
+
+
+def http_session():
+    """
+    Returns the keep-alive HTTP session that is shared by all Spotify requests made by this process.
+
+    All requests made with the session are rate limited by one RequestScheduler, and retried if rate limited.
+    """
+    global _shared_session
+    with _shared_lock:
+        if _shared_session is None:
+            session = ScheduledSession(RequestScheduler())
+            adapter = HTTPAdapter(pool_connections=SPOTIFY_HTTP_POOL_CONNECTIONS, pool_maxsize=SPOTIFY_HTTP_POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _shared_session = session
+        return _shared_session
+
 
 def spotify():
-    return spotipy.Spotify(auth=client_credentials_token())
+    """
+    Returns the Spotify client that is shared by this process.
+
+    The client reuses pooled connections, and refreshes the client credentials token as needed.
+    """
+    global _shared_client
+    session = http_session()
+    with _shared_lock:
+        if _shared_client is None:
+            _shared_client = spotipy.Spotify(
+                requests_session=session, client_credentials_manager=ClientCredentialsManager())
+        return _shared_client
+
+
+def cached_spotify():
+    """
+    Returns the shared Spotify client, wrapped so that search and album responses are cached.
+
+    The wrapper is shared by this process, so that its hit / miss statistics cover all its users.
+    """
+    global _shared_cached_client
+    client = spotify()
+    with _shared_lock:
+        if _shared_cached_client is None:
+            _shared_cached_client = CachedSpotify(client)
+        return _shared_cached_client
 
 
 def spotify_cache():
@@ -34,7 +113,7 @@ def fetch_new_client_credentials_token():
 
     auth_token = b64encode('{}:{}'.format(settings.SPOTIFY_CLIENT_ID, settings.SPOTIFY_CLIENT_SECRET).encode('ascii'))
     headers = {'Authorization': b'Basic ' + auth_token}
-    r = requests.post(CLIENT_CREDENTIALS_URL, data=data, headers=headers)
+    r = http_session().post(CLIENT_CREDENTIALS_URL, data=data, headers=headers)
     r.raise_for_status()
     result = r.json()
     return result['access_token'], result['token_type'], result['expires_in']
@@ -1,6 +1,9 @@
 from unittest import TestCase
+import time
 import spotipy
-from spotify.spotify import spotify_cache, client_credentials_token, find_track
+from spotify.spotify import spotify, spotify_cache, client_credentials_token, find_track
+from spotify.response_cache import search_cache_key
+from spotify.scheduler import RequestScheduler
 
 
 class ClientCredentialsToken(TestCase):
@@ -15,6 +18,45 @@ class ClientCredentialsToken(TestCase):
         self.assertEqual(token, token2)
 
 
+class SharedClient(TestCase):
+
+    def test_client_shared(self):
+        self.assertIs(spotify(), spotify())
+
+
+class ResponseCacheKey(TestCase):
+
+    def test_equivalent_queries_share_key(self):
+        key = search_cache_key('track:"rainy" artist:"bob dylan"', 'track', 40, 0, 'CH')
+        key2 = search_cache_key('  track:"Rainy"   artist:"Bob Dylan"', 'track', 40, 0, 'CH')
+        self.assertEqual(key, key2)
+
+    def test_paging_and_market_in_key(self):
+        key = search_cache_key('track:"rainy"', 'track', 40, 0, 'CH')
+        self.assertNotEqual(key, search_cache_key('track:"rainy"', 'track', 40, 40, 'CH'))
+        self.assertNotEqual(key, search_cache_key('track:"rainy"', 'track', 20, 0, 'CH'))
+        self.assertNotEqual(key, search_cache_key('track:"rainy"', 'track', 40, 0, 'US'))
+
+
+class Scheduler(TestCase):
+
+    def test_burst_then_rate_limited(self):
+        scheduler = RequestScheduler(rate=20, burst=3)
+        start = time.monotonic()
+        for _ in range(3):
+            scheduler.acquire()
+        self.assertLess(time.monotonic() - start, 0.04)
+        scheduler.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+    def test_pause(self):
+        scheduler = RequestScheduler(rate=100, burst=10)
+        scheduler.pause(0.1)
+        start = time.monotonic()
+        scheduler.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
 class SearchTrack(TestCase):
 
     def test_search_track(self):
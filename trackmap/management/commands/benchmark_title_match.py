@@ -0,0 +1,116 @@
+import re
+import time
+from django.core.management.base import BaseCommand, CommandError
+from rphistory.models import Song
+from trackmap.normalize import live_pattern, simplify, unplugged_pattern
+from trackmap.trackmap import title_matcher
+
+
+def inline_title_match(expected_title, expected_title_simple, search_result_title_simple):
+    """
+    The title matching as it was done before TitleMatcher: the regular expressions are built for every
+    search result, and compiled (or looked up in the re module's cache) by re.match().
+    """
+    match_score = 1.0
+    track_match = expected_title_simple == search_result_title_simple
+
+    if not track_match:
+        match_score = 0.9
+        regex = r"^(the)?" + expected_title_simple + r"(\d{4})?((digital)?(remaster(ed)?)(version)?)?"
+        track_match = re.match(regex, search_result_title_simple)
+
+        if not track_match:
+            match_score = 0.6
+            regex = r"^(the)?" + expected_title_simple + r"(instrumental|vocal|acoustic|live|original)?"
+            track_match = re.match(regex, search_result_title_simple)
+
+            if not track_match:
+                match_score = 0.5
+                if '(' in expected_title:
+                    try:
+                        base_track = live_pattern.match(expected_title_simple).groups()[0]
+                        base_item = unplugged_pattern.match(search_result_title_simple).groups()[0]
+                        track_match = base_track == base_item
+                    except:
+                        pass
+
+                if not track_match:
+                    match_score = 0
+
+    return match_score
+
+
+def cached_title_match(expected_title, expected_title_simple, search_result_title_simple):
+    return title_matcher(expected_title, expected_title_simple).score(search_result_title_simple)
+
+
+def search_result_titles(title_simple, other_titles_simple):
+    """
+    :return: list of simplified titles like those returned by a Spotify search for the title
+    """
+    return [
+        title_simple,
+        title_simple + '2011remaster',
+        'the' + title_simple + 'digitalremasteredversion',
+        title_simple + 'live',
+        title_simple + 'mtvunpluggedversion',
+    ] + other_titles_simple
+
+
+class Command(BaseCommand):
+    help = ('Compares the time taken by the title matching with regular expressions built for every search result '
+            'and with cached title matchers, on the titles of songs in the database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--songs', dest='songs', nargs='?', type=int, default=200,
+                            help='Number of song titles to match (default: 200)')
+        parser.add_argument('--results', dest='results', nargs='?', type=int, default=45,
+                            help='Number of other song titles added to the search results of each title (default: 45)')
+        parser.add_argument('--queries', dest='queries', nargs='?', type=int, default=3,
+                            help='Number of times the search results of each title are matched, like the '
+                                 'several queries done for one song (default: 3)')
+        parser.add_argument('--repeat', dest='repeat', nargs='?', type=int, default=3,
+                            help='Run each method this many times, and report the fastest time (default: 3)')
+
+    def handle(self, *args, **options):
+        titles = list(Song.objects.order_by('id').values_list('title', flat=True)[:options['songs']])
+        if not titles:
+            raise CommandError("There are no songs in the database")
+
+        simple_titles = [simplify(title) for title in titles]
+        other_count = max(0, options['results'])
+        cases = []
+        for i, (title, title_simple) in enumerate(zip(titles, simple_titles)):
+            others = [simple_titles[(i + j) % len(simple_titles)] for j in range(1, other_count + 1)]
+            cases.append((title, title_simple, search_result_titles(title_simple, others)))
+
+        queries = max(1, options['queries'])
+        match_count = sum(len(results) for _, _, results in cases) * queries
+        self.stdout.write("{} titles, {} matches per run".format(len(cases), match_count))
+
+        scores = {}
+        for name, match in (('inline', inline_title_match), ('cached', cached_title_match)):
+            times = []
+            for _ in range(max(1, options['repeat'])):
+                # Start each run with empty caches, so that the compilation of the regular expressions is included.
+                re.purge()
+                title_matcher.cache_clear()
+                run_scores = []
+                start = time.perf_counter()
+                for title, title_simple, results in cases:
+                    for _ in range(queries):
+                        for result in results:
+                            try:
+                                run_scores.append(match(title, title_simple, result))
+                            except re.error:
+                                # The inline expressions are not escaped, and fail for some titles.
+                                run_scores.append(None)
+                times.append(time.perf_counter() - start)
+            scores[name] = run_scores
+            self.stdout.write("{}: {:.1f} ms ({:.2f} us per match)".format(
+                name, min(times) * 1000, min(times) * 1000000 / match_count))
+
+        differences = sum(1 for inline, cached in zip(scores['inline'], scores['cached']) if inline != cached)
+        if differences:
+            self.stdout.write("Scores differ for {} matches (unescaped titles in the inline expressions)".format(
+                differences))
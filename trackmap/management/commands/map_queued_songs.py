@@ -0,0 +1,123 @@
+import select
+import time
+import psycopg2
+from django.db import connection, DatabaseError
+from rphistory.models import Song
+from trackmap.management.commands.map_tracks import Command as MapTracksCommand
+from trackmap.models import SongMappingQueue
+from trackmap.settings import TRACKMAP_QUEUE_CLAIM_TIMEOUT
+from trackmap.trackmap import utc_now
+from logging import getLogger
+
+
+log = getLogger(__name__)
+
+
+def wait_for_notification(pg_connection, timeout):
+    """
+    Waits until a notification is received on the (listening) psycopg2 connection, or until timeout seconds passed.
+
+    :return: True if a notification was received
+    """
+    if select.select([pg_connection], [], [], timeout) == ([], [], []):
+        return False
+    pg_connection.poll()
+    received = bool(pg_connection.notifies)
+    del pg_connection.notifies[:]
+    return received
+
+
+class Command(MapTracksCommand):
+    help = 'Maps the songs queued by load_playlist to Spotify tracks, as soon as they are queued'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', dest='once', action='store_true', default=False,
+                            help='Exit when the queue is empty, instead of waiting for more songs to be queued')
+        parser.add_argument('--poll-interval', dest='poll_interval', nargs='?', type=int, default=60,
+                            help='Check the queue after this many seconds even if no notification of newly queued '
+                                 'songs was received, and retry this many seconds after an error (default: 60)')
+        parser.add_argument('--workers', dest='workers', nargs='?', type=int, default=1,
+                            help='Split the claimed songs across <workers> threads (default: 1)')
+        parser.add_argument('--batch-size', dest='batch_size', nargs='?', type=int, default=20,
+                            help='Claim and search for up to <batch-size> queued songs at a time (default: 20)')
+        parser.add_argument('--no-response-cache', dest='no_response_cache', action='store_true', default=False,
+                            help='Always query Spotify, instead of using cached search and album responses')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        if workers < 1:
+            raise ValueError("--workers must be at least 1")
+        self.init_processing(options['batch_size'], not options['no_response_cache'])
+
+        pg_connection = None
+        claimed_ids = []
+        processed_count = 0
+        found_count = 0
+        try:
+            while True:
+                try:
+                    # Listen before claiming, so that no notification is missed between the claim and the wait.
+                    if pg_connection is None and not options['once']:
+                        pg_connection = SongMappingQueue.objects.listen()
+
+                    claimed_ids = SongMappingQueue.objects.claim(
+                        self.batch_size * workers, TRACKMAP_QUEUE_CLAIM_TIMEOUT)
+                    if claimed_ids:
+                        processed, found = self.process_queued_songs(claimed_ids, workers)
+                        claimed_ids = []
+                        processed_count += processed
+                        found_count += found
+                        continue
+
+                    if options['once']:
+                        break
+                    wait_for_notification(pg_connection, options['poll_interval'])
+                except Exception as e:
+                    log.exception("map_queued_songs: error while mapping {} claimed songs: {}".format(
+                        len(claimed_ids), e))
+                    if isinstance(e, (DatabaseError, psycopg2.Error)):
+                        # The connection may be unusable.  It is reopened when next used, and listens again.
+                        connection.close()
+                        pg_connection = None
+                    self.release_claimed(claimed_ids)
+                    claimed_ids = []
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            self.release_claimed(claimed_ids)
+        finally:
+            if pg_connection is not None:
+                connection.close()
+
+        self.stdout.write("Processed {} queued songs.  Matching Spotify tracks found for {} of these songs.".format(
+            processed_count, found_count))
+        self.write_stats()
+
+    def release_claimed(self, song_ids):
+        """
+        Releases the claim on songs that were not mapped, so that they are claimed again.
+        """
+        if not song_ids:
+            return
+        try:
+            SongMappingQueue.objects.release(song_ids)
+        except DatabaseError as e:
+            log.error("map_queued_songs: could not release {} claimed songs, they will be claimed again after "
+                      "{} seconds: {}".format(len(song_ids), TRACKMAP_QUEUE_CLAIM_TIMEOUT, e))
+            connection.close()
+
+    def process_queued_songs(self, song_ids, workers):
+        """
+        Maps the claimed songs, and removes them from the queue.
+
+        Songs that were already searched for in the meantime (e.g. by map_tracks) are not searched for again.
+
+        :return: tuple (count of songs processed, count of songs for which a match was found)
+        """
+        songs = list(Song.objects.filter(id__in=song_ids, search_history__isnull=True)
+                     .select_related('album').prefetch_related('artists').order_by('id'))
+        found_count = self.process_chunk(songs, workers, utc_now(), False) if songs else 0
+        SongMappingQueue.objects.filter(rp_song_id__in=song_ids).delete()
+        self.stdout.write("Mapped {} queued songs, matches found for {}".format(len(songs), found_count))
+        return len(songs), found_count
@@ -1,13 +1,53 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import json
+import threading
 from django.core.management.base import BaseCommand
+from django.db import connection
 from django.db.models import Q
 from rphistory.models import Song
-from trackmap.models import TrackSearchHistory, delete_references_to_rp_history_song
-from trackmap.trackmap import TrackSearch, utc_now
+from spotify.spotify import cached_spotify
+from trackmap.models import MapTracksJob, TrackSearchHistory, delete_references_to_rp_history_song
+from trackmap.trackmap import TrackSearch, chunks, utc_now
 from logging import getLogger
 
 
 log = getLogger(__name__)
 
+# The options that select the songs processed by a job.  These are saved with the job, and reused when it is resumed.
+JOB_OPTIONS = ('limit', 'failed', 'force', 'rp_song_id', 'artist_id', 'delete_all_references', 'chunk_size')
+
+DEFAULT_JOB_CHUNK_SIZE = 200
+
+
+def songs_by_id_chunks(queryset, chunk_size, limit=None):
+    """
+    Iterates over the songs selected by queryset in chunks, ordered by id, using keyset pagination.
+
+    Only one chunk of songs (and their prefetched related objects) is loaded at a time, and each chunk is
+    selected with a fresh query starting after the last id of the previous chunk.
+
+    :param queryset: Song queryset
+    :param int chunk_size: max number of songs per chunk
+    :param int limit: max total number of songs, or None for no limit
+    :return: generator of lists of Song objects
+    """
+    last_id = None
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = chunk_size if remaining is None else min(chunk_size, remaining)
+        chunk_queryset = queryset.order_by('id')
+        if last_id is not None:
+            chunk_queryset = chunk_queryset.filter(id__gt=last_id)
+        songs = list(chunk_queryset[:size])
+        if not songs:
+            return
+        yield songs
+        last_id = songs[-1].id
+        if remaining is not None:
+            remaining -= len(songs)
+
 
 class Command(BaseCommand):
     help = 'Maps new Radio Paradise playlist songs to Spotify tracks'
@@ -25,7 +65,7 @@ class Command(BaseCommand):
                             help='Only process the given radio paradise song id (Song.rp_song_id value)')
         parser.add_argument('--artistid', dest='artist_id', nargs='?', type=int, default=None,
                             help='Process all songs by the artist (Artist.id)')
-        parser.add_argument('--oldest', dest='oldest', action='store_true', default='false',
+        parser.add_argument('--oldest', dest='oldest', action='store_true', default=False,
                             help='Orders the results by the oldest track search date')
         parser.add_argument('--delete-all-references-first', action='store_true', dest='delete_all_references',
                             default=False,
@@ -39,9 +79,57 @@ class Command(BaseCommand):
         parser.add_argument('--slice', dest='slice_string', nargs='?', type=str, default=None,
                             help='Slice the resulting Song queryset, e.g. --slice 10:20 would only process items '
                                  '10 - 19 of the queryset that selects the songs to process')
+        parser.add_argument('--workers', dest='workers', nargs='?', type=int, default=1,
+                            help='Split the selected songs across <workers> threads, each of which uses its own '
+                                 'database connection.  The threads share the pooled Spotify client, whose '
+                                 'requests are rate limited together (default: 1)')
+        parser.add_argument('--batch-size', dest='batch_size', nargs='?', type=int, default=20,
+                            help='Search for <batch-size> songs at a time, so that the full album info for '
+                                 'all their search results can be fetched together (default: 20)')
+        parser.add_argument('--chunk-size', dest='chunk_size', nargs='?', type=int, default=None,
+                            help='Stream the selected songs in chunks of <chunk-size> songs, ordered by Song.id, '
+                                 'instead of loading them all before starting.  Progress is reported after each '
+                                 'chunk.  Can not be combined with --oldest, --slice or a negative --limit.')
+        parser.add_argument('--start-after-id', dest='start_after_id', nargs='?', type=int, default=None,
+                            help='Only process songs with a Song.id greater than this value, e.g. to resume an '
+                                 'interrupted --chunk-size run from the last reported id')
+        parser.add_argument('--job', dest='job', action='store_true', default=False,
+                            help='Record the run as a resumable job (implies --chunk-size, default {}).  The job '
+                                 'id is printed, and the job\'s progress is saved after each chunk'.format(
+                                    DEFAULT_JOB_CHUNK_SIZE))
+        parser.add_argument('--resume', dest='resume_job_id', nargs='?', type=int, default=None,
+                            help='Resume the given job (MapTracksJob.id) after the last song it processed.  The '
+                                 'song selection options that the job was started with are used')
+        parser.add_argument('--max-minutes', dest='max_minutes', nargs='?', type=int, default=None,
+                            help='Stop after the chunk during which this many minutes have elapsed, so that long '
+                                 'jobs can be run in bounded windows with --resume')
+        parser.add_argument('--no-response-cache', dest='no_response_cache', action='store_true', default=False,
+                            help='Always query Spotify, instead of using cached search and album responses')
 
     def handle(self, *args, **options):
 
+        job = None
+        if options['resume_job_id'] is not None:
+            try:
+                job = MapTracksJob.objects.get(id=options['resume_job_id'])
+            except MapTracksJob.DoesNotExist:
+                raise ValueError("No job found with id {}".format(options['resume_job_id']))
+            if job.finished is not None:
+                raise ValueError("Job {} already finished at {}".format(job.id, job.finished))
+            options.update(json.loads(job.options))
+            options['start_after_id'] = job.last_song_id
+            if options['limit'] is not None:
+                options['limit'] -= job.processed_count
+        elif options['job']:
+            if options['chunk_size'] is None:
+                options['chunk_size'] = DEFAULT_JOB_CHUNK_SIZE
+            if options['start_after_id'] is not None or options['slice_string'] is not None or options['oldest']:
+                raise ValueError("--job can not be used with --start-after-id, --slice or --oldest")
+
+        max_minutes = options['max_minutes']
+        if max_minutes is not None and options['chunk_size'] is None:
+            raise ValueError("--max-minutes can only be used with --chunk-size, --job or --resume")
+
         limit = options['limit']
         slice_string = options['slice_string']
         song_id = options['rp_song_id']
@@ -49,10 +137,23 @@ class Command(BaseCommand):
         delete_all_references = options['delete_all_references']
         force = options['force']
         oldest = options['oldest']
+        workers = options['workers']
+        chunk_size = options['chunk_size']
+        start_after_id = options['start_after_id']
+        self.init_processing(options['batch_size'], not options['no_response_cache'])
 
         if limit is not None and slice_string is not None:
             raise ValueError("Only one of --limit or --slice can be used.")
 
+        if workers < 1:
+            raise ValueError("--workers must be at least 1")
+
+        if chunk_size is not None:
+            if chunk_size < 1:
+                raise ValueError("--chunk-size must be at least 1")
+            if oldest or slice_string is not None or (limit is not None and limit < 0):
+                raise ValueError("--chunk-size can not be used with --oldest, --slice or a negative --limit")
+
         slice_tuple = None
 
         if oldest:
@@ -95,41 +196,178 @@ class Command(BaseCommand):
         if artist_id is not None:
             filters.append(Q(artists__id=artist_id))
 
-        new_songs = Song.objects.filter(*filters).select_related('album').prefetch_related('artists').order_by(order_by)
+        if start_after_id is not None:
+            filters.append(Q(id__gt=start_after_id))
 
-        if slice_tuple is not None:
-            start, stop = slice_tuple
-            new_songs = new_songs[start:stop]
+        new_songs = Song.objects.filter(*filters).select_related('album').prefetch_related('artists')
 
         now = utc_now()
-        track_search = TrackSearch()
-        found_count = 0
-        for song in new_songs:
-            if delete_all_references:
-                delete_references_to_rp_history_song(song.id)
-
-            matches, scores = track_search.find_matching_tracks(song)
-            if matches:
-                track_availabilities = track_search.create_tracks(song, matches, scores)
-                track_search.update_db_with_availibility(song, track_availabilities)
-                found = True
-                found_count += 1
-            else:
-                # TODO: if not found, try harder: (also see TODOs in find_matching_tracks, might be better handled there)
-                # * get album info from asin - if title is different, try with asin title
-                # * if spotify album found matching asin title, but not the track: record in HandmappedTracks,
-                #   it is probably a typo.
-
-                found = False
-            if not found:
-                artists = ','.join([artist.name for artist in song.artists.all()])
-                log.info("Not found: [{}] - {} (album: {}, asin: {})".format(
-                    artists, song.corrected_title or song.title, song.album.title, song.album.asin))
-
-            TrackSearchHistory.objects.update_or_create(
-                rp_song=song,
-                defaults={'search_time': now, 'found': found}
+        if options['job'] and job is None:
+            job = MapTracksJob.objects.create(
+                options=json.dumps({name: options[name] for name in JOB_OPTIONS}),
+                started=now,
             )
+            self.stdout.write("Started job {}".format(job.id))
+        stop_time = now + timedelta(minutes=max_minutes) if max_minutes is not None else None
+
+        if chunk_size is None:
+            new_songs = new_songs.order_by(order_by)
+            if slice_tuple is not None:
+                start, stop = slice_tuple
+                new_songs = new_songs[start:stop]
+            songs = list(new_songs)
+            processed_count = len(songs)
+            found_count = self.process_chunk(songs, workers, now, delete_all_references)
+        else:
+            processed_count = 0
+            found_count = 0
+            all_processed = True
+            for songs in songs_by_id_chunks(new_songs, chunk_size, limit=limit):
+                chunk_found_count = self.process_chunk(songs, workers, now, delete_all_references)
+                found_count += chunk_found_count
+                processed_count += len(songs)
+                if job is not None:
+                    self.checkpoint_job(job, songs[-1].id, len(songs), chunk_found_count)
+                self.stdout.write("Processed songs up to Song.id {} ({} songs so far)".format(
+                    songs[-1].id, processed_count))
+                if stop_time is not None and utc_now() >= stop_time:
+                    all_processed = False
+                    break
+
+            if job is not None:
+                if all_processed:
+                    job.finished = utc_now()
+                    job.save(update_fields=['finished'])
+                    self.stdout.write("Job {} finished".format(job.id))
+                else:
+                    self.stdout.write("Stopping after {} minutes.  Continue with --resume {}".format(
+                        max_minutes, job.id))
 
         self.stdout.write("Processed {} songs.  Matching Spotify tracks found for {} of these songs.".format(
-            len(new_songs), found_count))
+            processed_count, found_count))
+        self.write_stats()
+
+    def init_processing(self, batch_size, use_response_cache):
+        """
+        Sets up the state shared by the threads processing songs.
+        """
+        self.use_response_cache = use_response_cache
+        self.batch_size = max(1, batch_size)
+        self.query_stats = Counter()
+        self.availability_changes = Counter()
+        self.stats_lock = threading.Lock()
+
+    def write_stats(self):
+        self.stdout.write("Spotify queries: {} run, {} skipped.  Best matches found by query kind: {}".format(
+            self.query_stats['queries_run'], self.query_stats['queries_skipped'],
+            ', '.join('{}: {}'.format(kind, self.query_stats['best_match_' + kind]) for kind in TrackSearch.QUERY_PLAN)
+        ))
+        self.stdout.write("Spotify result pages: {} fetched, {} avoided.".format(
+            self.query_stats['pages_fetched'], self.query_stats['pages_avoided']))
+        self.stdout.write("Track availabilities: {} inserted, {} updated, {} deleted, {} unchanged.".format(
+            self.availability_changes['inserted'], self.availability_changes['updated'],
+            self.availability_changes['deleted'], self.availability_changes['unchanged']))
+        if self.use_response_cache:
+            self.stdout.write("Spotify response cache: {}".format(cached_spotify().stats_summary()))
+
+    def checkpoint_job(self, job, last_song_id, processed_count, found_count):
+        """
+        Saves the job's progress after a chunk of songs has been processed and committed.
+        """
+        job.last_song_id = last_song_id
+        job.processed_count += processed_count
+        job.found_count += found_count
+        job.last_checkpoint = utc_now()
+        job.save(update_fields=['last_song_id', 'processed_count', 'found_count', 'last_checkpoint'])
+
+    def process_chunk(self, songs, workers, now, delete_all_references):
+        """
+        Processes the songs, split across the given number of worker threads.
+
+        :return: count of songs for which a match was found
+        """
+        if workers == 1:
+            return self.process_songs(songs, now, delete_all_references, close_connection=False)
+
+        # Each worker gets every n-th song, so that the workers are evenly loaded
+        # even if songs are e.g. ordered by artist.
+        song_lists = [songs[i::workers] for i in range(workers)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self.process_songs, song_list, now, delete_all_references)
+                for song_list in song_lists
+            ]
+            return sum(future.result() for future in futures)
+
+    def process_songs(self, songs, now, delete_all_references, close_connection=True):
+        """
+        Finds and saves the matching tracks for each song.
+
+        The songs are searched for in batches of self.batch_size songs.  When run in a worker thread,
+        the thread's database connection is closed when done.
+
+        :param songs: iterable of rphistory.Song objects
+        :param datetime now: search time to record in TrackSearchHistory
+        :param bool delete_all_references: delete all Trackmap references to song before processing
+        :param bool close_connection: close the database connection used by the current thread when done
+        :return: count of songs for which a match was found
+        """
+        track_search = TrackSearch(use_response_cache=self.use_response_cache)
+        try:
+            found_count = 0
+            for batch in chunks(songs, self.batch_size):
+                batch_matches = track_search.find_matching_tracks_batch(batch)
+                if delete_all_references:
+                    for song in batch:
+                        delete_references_to_rp_history_song(song.id)
+
+                # The tracks and albums of all songs in the batch are saved together.
+                found = [(song, matches, scores) for song, (matches, scores) in zip(batch, batch_matches) if matches]
+                batch_availabilities = track_search.create_tracks_batch(found)
+                availabilities = {song.id: song_availabilities
+                                  for (song, _, _), song_availabilities in zip(found, batch_availabilities)}
+
+                for song, (matches, scores) in zip(batch, batch_matches):
+                    if self.save_song_matches(
+                            track_search, song, matches, scores, availabilities.get(song.id), now):
+                        found_count += 1
+            return found_count
+        finally:
+            with self.stats_lock:
+                self.query_stats.update(track_search.query_stats)
+            if close_connection:
+                connection.close()
+
+    def save_song_matches(self, track_search, song, matches, scores, track_availabilities, now):
+        """
+        Saves the availability of the matching tracks found for the song, and records the search in
+        TrackSearchHistory.
+
+        :param track_availabilities: list of TrackAvailability objects for the matches (as returned by
+                                     TrackSearch.create_tracks), or None if there are no matches
+        :return: bool: True if a match was found
+        """
+        match_query_kind = None
+        if matches:
+            changes = track_search.update_db_with_availibility(song, track_availabilities)
+            with self.stats_lock:
+                self.availability_changes.update(changes)
+            found = True
+            match_query_kind = matches[max(scores, key=scores.get)].query_kind
+        else:
+            # TODO: if not found, try harder: (also see TODOs in find_matching_tracks, might be better handled there)
+            # * get album info from asin - if title is different, try with asin title
+            # * if spotify album found matching asin title, but not the track: record in HandmappedTracks,
+            #   it is probably a typo.
+
+            found = False
+        if not found:
+            artists = ','.join([artist.name for artist in song.artists.all()])
+            log.info("Not found: [{}] - {} (album: {}, asin: {})".format(
+                artists, song.corrected_title or song.title, song.album.title, song.album.asin))
+
+        TrackSearchHistory.objects.update_or_create(
+            rp_song=song,
+            defaults={'search_time': now, 'found': found, 'match_query_kind': match_query_kind}
+        )
+        return found
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-17 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trackmap', '0007_tracksearchhistory_last_manual_check'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tracksearchhistory',
+            name='match_query_kind',
+            field=models.CharField(blank=True, help_text='Kind of query that found the best match (e.g. isrc)', max_length=20, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-17 12:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trackmap', '0008_tracksearchhistory_match_query_kind'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MapTracksJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('options', models.TextField(help_text='JSON encoded map_tracks options that select the songs to process')),
+                ('started', models.DateTimeField()),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('last_checkpoint', models.DateTimeField(blank=True, null=True)),
+                ('last_song_id', models.IntegerField(blank=True, help_text='Id of the last Song processed (cursor)', null=True)),
+                ('processed_count', models.IntegerField(default=0)),
+                ('found_count', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-17 13:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rphistory', '0006_increse_isrc_field_lenth_20160304_1947'),
+        ('trackmap', '0009_maptracksjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SongMappingQueue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('queued_at', models.DateTimeField()),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('rp_song', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='mapping_queue_entry', to='rphistory.Song')),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.12 on 2026-10-17 16:55
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rphistory', '0006_increse_isrc_field_lenth_20160304_1947'),
+        ('trackmap', '0010_songmappingqueue'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='trackavailability',
+            index_together=set([('rp_song', 'country', 'track')]),
+        ),
+    ]
@@ -1,27 +1,99 @@
 from logging import getLogger, DEBUG
-from django.db import models
+from django.db import connection, models
 from django.apps import apps
 
 from trackmap import trackmap_cache
+from trackmap.signals import song_tracks_changed
 
 
 log = getLogger(__name__)
 
 
+class UpsertManager(models.Manager):
+    def upsert(self, rows, key_field='spotify_id'):
+        """
+        Inserts the rows, or updates the existing rows with the same key_field value if any value changed.
+
+        Uses Postgresql's INSERT ... ON CONFLICT (Postgresql 9.5+).  Two queries are made at most, independent
+        of the number of rows: the upsert itself, and a select for the ids of the existing rows that were
+        unchanged (and so were not returned by the upsert).
+
+        The rows are written in key_field order, so that concurrent upserts of overlapping rows lock them
+        in the same order, instead of deadlocking.
+
+        :param rows: list of dicts of column name => value.  All dicts must have the same keys.
+                     If several rows have the same key_field value, the first one is used.
+        :param key_field: name of the unique column that identifies a row
+        :return: dict of key_field value => id
+        """
+        unique_rows = {}
+        for row in rows:
+            unique_rows.setdefault(row[key_field], row)
+        if not unique_rows:
+            return {}
+
+        rows = [unique_rows[key_value] for key_value in sorted(unique_rows)]
+        update_columns = [column for column in rows[0] if column != key_field]
+        columns = [key_field] + update_columns
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        key = qn(key_field)
+
+        sql = '''
+            INSERT INTO {table} AS t ({columns})
+                 VALUES {values}
+            ON CONFLICT ({key}) DO UPDATE
+                    SET {set_clause}
+                  WHERE ({current_values}) IS DISTINCT FROM ({new_values})
+              RETURNING t.{key}, t.id
+            '''.format(
+            table=table,
+            columns=', '.join(qn(column) for column in columns),
+            values=', '.join(['({})'.format(', '.join(['%s'] * len(columns)))] * len(rows)),
+            key=key,
+            set_clause=', '.join('{0} = EXCLUDED.{0}'.format(qn(column)) for column in update_columns),
+            current_values=', '.join('t.' + qn(column) for column in update_columns),
+            new_values=', '.join('EXCLUDED.' + qn(column) for column in update_columns),
+        )
+        params = [row[column] for row in rows for column in columns]
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            ids = dict(cursor.fetchall())
+            unchanged = [key_value for key_value in unique_rows if key_value not in ids]
+            if unchanged:
+                cursor.execute(
+                    'SELECT {key}, id FROM {table} WHERE {key} IN %s'.format(key=key, table=table),
+                    [tuple(unchanged)])
+                ids.update(cursor.fetchall())
+        return ids
+
+
 class Album(models.Model):
     spotify_id = models.CharField(max_length=120, unique=True, help_text="A spotify album id")
     title = models.CharField(max_length=255, blank=False, help_text="Album title")
     img_small_url = models.URLField(null=True)
     img_medium_url = models.URLField(null=True)
     img_large_url = models.URLField(null=True)
+    objects = UpsertManager()
 
     def __str__(self):
         return "<Album>: {} (spotify_id: {}) (id: {})".format(self.title, self.spotify_id, self.id)
 
 
-class TrackManager(models.Manager):
+class TrackManager(UpsertManager):
     def get_available_tracks(self, country, start_time=None, limit=15):
+        sql, params = self.available_tracks_sql(country, start_time=start_time, limit=limit)
+        qs = self.raw(sql, params)
+        if not start_time:
+            qs = list(qs)
+            qs.reverse()
+        return qs
 
+    def available_tracks_sql(self, country, start_time=None, limit=15):
+        """
+        :return: tuple (sql, params) of the query used by get_available_tracks
+        """
         History = apps.get_model('rphistory', 'History')
         params = {'country': country, 'limit': limit}
         if start_time:
@@ -51,12 +123,7 @@ class TrackManager(models.Manager):
             date_clause=date_clause,
             order_direction=order_direction
         )
-
-        qs = self.raw(sql, params)
-        if not start_time:
-            qs = list(qs)
-            qs.reverse()
-        return qs
+        return sql, params
 
 
 class Track(models.Model):
@@ -96,6 +163,9 @@ class TrackAvailability(models.Model):
 
     class Meta:
         unique_together = (('track', 'rp_song', 'country'),)
+        # Covers the lookup of a song's tracks in a country (e.g. in TrackManager.get_available_tracks),
+        # without reading the table.
+        index_together = (('rp_song', 'country', 'track'),)
 
     def __str__(self):
         return "<TrackAvailability>: {} (rp_song_id: {}) (score: {}) (id: {})".format(
@@ -107,12 +177,128 @@ class TrackSearchHistory(models.Model):
     search_time = models.DateTimeField(null=False)
     found = models.BooleanField(default=False)
     last_manual_check = models.DateTimeField(null=True, blank=True)
+    match_query_kind = models.CharField(
+        max_length=20, null=True, blank=True, help_text="Kind of query that found the best match (e.g. isrc)")
 
     def __str__(self):
         return "<TrackSearchHistory>: {} (rp_song_id: {}) (found: {}) (id: {})".format(
             self.search_time, self.rp_song_id, self.found, self.id)
 
 
+class MapTracksJob(models.Model):
+    """
+    A resumable map_tracks run.
+
+    The songs selected by the job's options are processed in Song.id order, and last_song_id is
+    checkpointed after each chunk of songs has been committed, so that an interrupted job can be resumed.
+    """
+    options = models.TextField(help_text="JSON encoded map_tracks options that select the songs to process")
+    started = models.DateTimeField(null=False)
+    finished = models.DateTimeField(null=True, blank=True)
+    last_checkpoint = models.DateTimeField(null=True, blank=True)
+    last_song_id = models.IntegerField(null=True, blank=True, help_text="Id of the last Song processed (cursor)")
+    processed_count = models.IntegerField(default=0)
+    found_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return "<MapTracksJob>: {} (last_song_id: {}) (processed: {}) (finished: {}) (id: {})".format(
+            self.started, self.last_song_id, self.processed_count, self.finished, self.id)
+
+
+class SongMappingQueueManager(models.Manager):
+    # Postgresql NOTIFY channel used to wake up the queue consumer when songs are enqueued.
+    notify_channel = 'trackmap_song_mapping_queue'
+
+    def enqueue(self, song_ids):
+        """
+        Adds the songs to the queue (songs that are already queued are ignored), and notifies the consumer
+        if any songs were added.
+
+        The notification is only delivered when the current transaction commits.
+
+        :param song_ids: iterable of rphistory.Song ids
+        :return: count of songs added to the queue
+        """
+        song_ids = list(song_ids)
+        if not song_ids:
+            return 0
+
+        sql = '''
+            INSERT INTO {queue} (rp_song_id, queued_at)
+                 SELECT song_id, now() FROM unnest(%s::integer[]) AS song_id
+            ON CONFLICT (rp_song_id) DO NOTHING
+            '''.format(queue=self.model._meta.db_table)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [song_ids])
+            added = cursor.rowcount
+            if added > 0:
+                cursor.execute('NOTIFY {}'.format(self.notify_channel))
+        return added
+
+    def claim(self, limit, claim_timeout):
+        """
+        Claims up to limit queued songs, in the order they were queued.
+
+        Entries that are claimed by another consumer are skipped, unless their claim is older than
+        claim_timeout seconds (in which case the consumer is assumed to have died before finishing them).
+
+        :return: list of claimed rphistory.Song ids
+        """
+        sql = '''
+            UPDATE {queue}
+               SET claimed_at = now()
+             WHERE id IN (
+                     SELECT id
+                       FROM {queue}
+                      WHERE claimed_at IS NULL
+                            OR claimed_at < now() - %(claim_timeout)s * interval '1 second'
+                   ORDER BY id
+                      LIMIT %(limit)s
+                        FOR UPDATE SKIP LOCKED
+                   )
+         RETURNING rp_song_id
+            '''.format(queue=self.model._meta.db_table)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {'limit': limit, 'claim_timeout': claim_timeout})
+            return [row[0] for row in cursor.fetchall()]
+
+    def release(self, song_ids):
+        """
+        Releases the claim on the songs, so that they can be claimed again right away (e.g. after mapping them
+        failed).
+
+        :param song_ids: iterable of rphistory.Song ids
+        :return: count of queue entries released
+        """
+        return self.filter(rp_song_id__in=list(song_ids)).update(claimed_at=None)
+
+    def listen(self):
+        """
+        Starts listening for enqueue notifications on the current database connection.
+
+        :return: the underlying psycopg2 connection, to be passed to wait_for_notification()
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('LISTEN {}'.format(self.notify_channel))
+        return connection.connection
+
+
+class SongMappingQueue(models.Model):
+    """
+    Newly loaded songs that are waiting to be mapped to Spotify tracks by the map_queued_songs command.
+    """
+    rp_song = models.OneToOneField('rphistory.Song', related_name="mapping_queue_entry")
+    queued_at = models.DateTimeField(null=False)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    objects = SongMappingQueueManager()
+
+    def __str__(self):
+        return "<SongMappingQueue>: {} (rp_song_id: {}) (claimed_at: {}) (id: {})".format(
+            self.queued_at, self.rp_song_id, self.claimed_at, self.id)
+
+
 class HandmappedTrack(models.Model):
     #TODO: add logic to directly map song to track for known track_id
     # The idea here would be to present a user with:
@@ -146,6 +332,9 @@ def delete_references_to_rp_history_song(song_id):
 
     track_qs = Track.objects.filter(trackavailability__rp_song_id=song_id).distinct()
     albums = list(Album.objects.filter(track__in=track_qs))
+    # Other songs may have been mapped to the same tracks.
+    affected_song_ids = set(
+        TrackAvailability.objects.filter(track__in=track_qs).values_list('rp_song_id', flat=True))
 
     # Deleting Track objects will cascade the deletions to related TrackAvailability objects.
     if log.isEnabledFor(DEBUG):
@@ -159,3 +348,6 @@ def delete_references_to_rp_history_song(song_id):
             if log.isEnabledFor(DEBUG):
                 log.debug("Deleting album because it no longer has any associated tracks: {}".format(album))
             album.delete()
+
+    if affected_song_ids:
+        song_tracks_changed.send(sender=TrackAvailability, song_ids=list(affected_song_ids))
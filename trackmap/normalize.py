@@ -0,0 +1,163 @@
+"""
+Text normalization used when querying Spotify and when comparing Spotify results with Radio Paradise data.
+
+The normalization functions are memoized: the same artist names, titles and album names are normalized
+over and over again while scoring search results.
+"""
+from functools import lru_cache
+import re
+import string
+import unicodedata
+
+
+# Number of distinct strings for which normalized forms are remembered:
+CACHE_SIZE = 2 ** 16
+
+# Characters that can be stripped when comparing possible matches:
+strip_chars_pattern = re.compile('[{}]'.format(re.escape(string.punctuation + ' ')))
+
+# Characters that can be stripped when querying Spotify for a match:
+search_strip_chars_pattern = re.compile('[{}]'.format(
+    re.escape(string.punctuation.replace('-', '') \
+              .replace('&', '').replace('$', '').replace('#', '').replace('+', '').replace('/', '')
+              )))
+
+# Match things like ", part 2":
+part_x_pattern = re.compile(r',? (\((pt\.|part) \d+\)|(pt\.|part \d+))')
+
+# Match things like ", pt. 2" and " (part 2)", with a named group for the part number.
+# This also matches the "pt. 2" inside of "(pt. 2)"; the leftover parentheses are removed along with
+# all other non-word characters when simplifying.
+part_x_number_pattern = re.compile(r',? ?(pt\.|part) (?P<part_number>\d+)')
+
+# Match things like "(w/ Markus Garvey)" and "feat. Jerry Garcia":
+featuring_pattern = re.compile(r'\((w/|feat\.?|featuring) (?P<featuring>[^\)]+)\)')
+
+contains_featuring_pattern = re.compile('^.*' + featuring_pattern.pattern + '.*$')
+
+# Match all non-alphanumeric characters (unicode aware):
+strip_non_words_pattern = re.compile(r'[\W_]+', re.UNICODE)
+
+# Match text like .*(live|acoustic)
+live_pattern = re.compile(r'^(.*?)(live|acoustic)$')
+
+# Match text like .*(\(live|acoustic\))
+live_raw_pattern = re.compile(r'^(.*?)\s*\(\s*(live|acoustic)\s*\)\s*$', re.IGNORECASE)
+
+# Match text like .*(live|acoustic)
+unplugged_pattern = re.compile(r'^(.*?)((mtvunplugged(version)?)|unpluggedversion)$')
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def remove_accents(input_str):
+    nkfd_form = unicodedata.normalize('NFKD', input_str)
+    return "".join([c for c in nkfd_form if not unicodedata.combining(c)])
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def simplify(text, leave_feature=True):
+    """
+    Reduces text to a lower case string of word characters, suitable for comparing titles and names.
+
+    :param str text:
+    :param bool leave_feature: if False, remove "featuring" text like "(w/ foo)" completely
+    :return: str
+    """
+    text = text.lower().replace(' & ', ' and ').replace(' + ', ' and ')
+    text = part_x_number_pattern.sub(r' part\g<part_number>', text)
+    text = remove_featuring(text, leave_feature=leave_feature)
+    text = remove_leading_article(text)
+    text = remove_accents(strip_non_words_pattern.sub('', text))
+    return strip_chars_pattern.sub('', text)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def prepare_for_search(text):
+    """
+    Remove accents and remove leading 'a ' or 'the ', and punctuation characters.
+    """
+    if text is None:
+        return None
+
+    plain_text = remove_accents(text).strip().lower()
+    plain_text = remove_leading_article(plain_text)
+    plain_text = remove_part_x(plain_text)
+    plain_text = remove_featuring(plain_text, leave_feature=False)
+    plain_text = search_strip_chars_pattern.sub('', plain_text)
+    return plain_text.strip()
+
+
+def remove_leading_article(text):
+    """
+    Remove a leading 'a ' or 'the ', but only if the remaining string is at least 3 characters long.
+
+    :param str text:
+    :return: str
+    """
+    if text.startswith('a '):
+        stripped_text = text[2:]
+    elif text.startswith('the '):
+        stripped_text = text[4:]
+    else:
+        return text
+
+    if len(stripped_text) < 3:
+        return text
+
+    return stripped_text
+
+
+def remove_part_x(text):
+    return part_x_pattern.sub('', text)
+
+
+def remove_featuring(text, leave_feature):
+    """
+    Transform things like "(w/ foo)" or "(featuring foo)" to simply "featuring foo" (or remove it completely)
+
+    :param text:
+    :param leave_feature: if True, do not remove "foo" if (w/ foo) is matched.  if False, remove the entire match.
+    :return:
+    """
+    if leave_feature:
+        return featuring_pattern.sub(r'featuring \g<featuring>', text)
+    else:
+        return featuring_pattern.sub('', text)
+
+
+def strip_live_marker(track_title):
+    match = live_raw_pattern.match(track_title)
+    if match:
+        return match.groups()[0]
+    else:
+        return track_title
+
+
+def add_simplified_names(items):
+    """
+    Stores the simplified form of the track, artist and album names on Spotify track result items,
+    in a ``simplified_name`` key, so that each name is only simplified once per item.
+
+    Modifies passed items.
+
+    :param items: track query result items
+    :return: None
+    """
+    for item in items:
+        item['simplified_name'] = simplify(item['name'])
+        for artist in item['artists']:
+            artist['simplified_name'] = simplify(artist['name'])
+        album = item['album']
+        if 'simplified_name' not in album:
+            album['simplified_name'] = simplify(album['name'])
+
+
+def simplified_name(obj):
+    """
+    :param obj: Spotify result dict (track item, artist or album) with a 'name' key
+    :return: the simplified name, precomputed by add_simplified_names() if possible
+    """
+    name = obj.get('simplified_name')
+    if name is None:
+        name = simplify(obj['name'])
+    return name
@@ -8,6 +8,13 @@ TRACKMAP_DEFAULT_TRACK_LIMIT = getattr(settings, 'TRACKMAP_DEFAULT_TRACK_LIMIT',
 TRACKMAP_DEFAULT_TIMEZONE = getattr(settings, 'TRACKMAP_DEFAULT_TIMEZONE', 'America/Los_Angeles')
 TRACKMAP_SESSION_EXPIRY = getattr(settings, 'TRACKMAP_SESSION_EXPIRY', 60*60*24*180)
 TRACKMAP_SESSION_RENEW_WHEN_SECONDS_LEFT = getattr(settings, 'TRACKMAP_SESSION_RENEW_WHEN_SECONDS_LEFT', 60*60*24*90)
+# Number of threads used to run a song's Spotify queries and album lookups concurrently (1 disables concurrency):
+TRACKMAP_SPOTIFY_QUERY_WORKERS = getattr(settings, 'TRACKMAP_SPOTIFY_QUERY_WORKERS', 4)
+# Stop paging through a query's results once an item scores at least this much (track, artist and album title
+# match, not counting the album year).  None always fetches all pages.
+TRACKMAP_PAGING_STOP_SCORE = getattr(settings, 'TRACKMAP_PAGING_STOP_SCORE', 300)
+# Queued songs claimed by a map_queued_songs consumer are handed out again if not done after this many seconds:
+TRACKMAP_QUEUE_CLAIM_TIMEOUT = getattr(settings, 'TRACKMAP_QUEUE_CLAIM_TIMEOUT', 600)
 
 COUNTRY_CODES = OrderedDict([
     ("AF", "Afghanistan"),
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+
+# Sent after the Spotify tracks available for songs changed (TrackAvailability objects added, updated or deleted).
+song_tracks_changed = Signal(providing_args=['song_ids'])
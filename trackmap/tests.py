@@ -1,5 +1,7 @@
 from unittest import TestCase
 
+from trackmap.normalize import prepare_for_search, simplify
+from trackmap.trackmap import TitleMatcher
 from trackmap.views import get_utc_start_time
 
 class Time(TestCase):
@@ -16,4 +18,49 @@ class Time(TestCase):
         self.assertEqual((2015, 3, 11, 13, 0), (utc.year, utc.month, utc.day, utc.hour, utc.minute))
 
 
+class Normalize(TestCase):
+    def test_simplify(self):
+        self.assertEqual('sunshineofyourlove', simplify('Sunshine Of Your Love'))
+        self.assertEqual('rockandroll', simplify('Rock & Roll'))
+        self.assertEqual('belafleck', simplify('Béla Fleck'))
+        self.assertEqual('songpart2', simplify('Song, Pt. 2'))
+        self.assertEqual('songpart2', simplify('Song (Part 2)'))
 
+    def test_simplify_featuring(self):
+        self.assertEqual('songfeaturingjerrygarcia', simplify('Song (feat. Jerry Garcia)'))
+        self.assertEqual('song', simplify('Song (feat. Jerry Garcia)', leave_feature=False))
+
+    def test_leading_article(self):
+        self.assertEqual('beat', simplify('The Beat'))
+        self.assertEqual('theox', simplify('The Ox'))
+
+    def test_prepare_for_search(self):
+        self.assertEqual('angelique kidjo', prepare_for_search('Angélique Kidjo'))
+        self.assertEqual('song', prepare_for_search('The Song, Part 2 (w/ Someone)'))
+        self.assertIsNone(prepare_for_search(None))
+
+
+class TitleMatch(TestCase):
+    def matcher(self, title):
+        return TitleMatcher(title, simplify(title))
+
+    def test_score_tiers(self):
+        matcher = self.matcher('Mr. Big Stuff')
+        self.assertEqual(1.0, matcher.score(simplify('Mr. Big Stuff')))
+        self.assertEqual(0.9, matcher.score(simplify('Mr. Big Stuff (2004 Remaster)')))
+        self.assertEqual(0, matcher.score(simplify('Big Stuff')))
+
+    def test_live_matches_unplugged(self):
+        matcher = self.matcher('Why? (Live)')
+        self.assertEqual(0.5, matcher.score(simplify('Why? [MTV Unplugged Version]')))
+
+    def test_regex_characters_in_title(self):
+        # Titles with characters that have a meaning in regular expressions:
+        for title, result_title in [('C.C. Rider', 'C.C. Rider - 2004 Remaster'),
+                                    ('Help!', 'Help! - Remastered 2009'),
+                                    ('1+1', '1+1'),
+                                    ('$10 Bill', '$10 Bill'),
+                                    ('Why? (Live)', 'Why? - Live')]:
+            self.assertLess(0, self.matcher(title).score(simplify(result_title)), title)
+        self.assertEqual(0, self.matcher('C.C. Rider').score(simplify('Cecil Rider')))
+        self.assertEqual(0, self.matcher('Why?').score(simplify('Who?')))
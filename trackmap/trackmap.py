@@ -1,22 +1,31 @@
-from collections import namedtuple
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
 import logging
+import threading
 from operator import itemgetter
 import re
-import string
-import unicodedata
 
 from django.db import transaction
 from django.db.utils import IntegrityError
 from django.utils import timezone
 
-from spotify.spotify import spotify
+from spotify.scheduler import with_current_priority
+from spotify.spotify import cached_spotify, spotify
 from trackmap.models import Album, Track, TrackAvailability
+from trackmap.signals import song_tracks_changed
+from trackmap.normalize import (
+    add_simplified_names, contains_featuring_pattern, live_pattern, prepare_for_search, simplified_name, simplify,
+    strip_live_marker, unplugged_pattern)
+from trackmap.settings import TRACKMAP_PAGING_STOP_SCORE, TRACKMAP_SPOTIFY_QUERY_WORKERS
 
 
 AlbumInfo = namedtuple('AlbumInfo', 'id title year img_small img_medium img_large match_score')
 ArtistInfo = namedtuple('ArtistInfo', 'id name multiple match_score')
 TrackInfo = namedtuple('TrackInfo', 'id title match_score')
-TrackArtistAlbum = namedtuple('TrackArtistAlbum', 'track_info artist_info album_info')
+# query_kind: kind of query (TrackSearch.QUERY_KIND_*) that found the match
+TrackArtistAlbum = namedtuple('TrackArtistAlbum', 'track_info artist_info album_info query_kind')
 
 
 log = logging.getLogger(__name__)
@@ -26,11 +35,6 @@ def utc_now():
     return timezone.now().replace(tzinfo=timezone.utc)
 
 
-def remove_accents(input_str):
-    nkfd_form = unicodedata.normalize('NFKD', input_str)
-    return "".join([c for c in nkfd_form if not unicodedata.combining(c)])
-
-
 def chunks(l, n):
     """
     Breaks a single list into several lists of size n.
@@ -42,6 +46,87 @@ def chunks(l, n):
     return [l[i:i + n] for i in range(0, len(l), n)]
 
 
+class TitleMatcher(object):
+    """
+    Scores how well simplified search result titles match an expected track title.
+
+    The regular expressions needed are compiled once, when the matcher is created.  Use title_matcher()
+    to get a (cached) matcher, so that the same matcher is reused for all search results for a title.
+    """
+
+    def __init__(self, expected_title, expected_title_simple):
+        """
+        :param str expected_title: the title, as given by Radio Paradise
+        :param str expected_title_simple: simplified version of the title to match search results against
+        """
+        self.expected_title = expected_title
+        self.expected_title_simple = expected_title_simple
+        escaped = re.escape(expected_title_simple)
+        # Accept things like "the <song name> 2004 remaster":
+        self.remaster_pattern = re.compile(r"^(the)?" + escaped + r"(\d{4})?((digital)?(remaster(ed)?)(version)?)?")
+        # Accept things like "the <song name> - instrumental ":
+        self.variant_pattern = re.compile(r"^(the)?" + escaped + r"(instrumental|vocal|acoustic|live|original)?")
+
+        # Sometimes there are songs like "Song (live)" that should match "Song [MTV Unplugged Version]"
+        self.live_base_title = None
+        if '(' in expected_title:
+            live_match = live_pattern.match(expected_title_simple)
+            if live_match:
+                self.live_base_title = live_match.groups()[0]
+
+    def score(self, search_result_title_simple):
+        """
+        :param str search_result_title_simple: simplified search result title
+        :return: float: match score; 0 if the title does not match
+        """
+        if self.expected_title_simple == search_result_title_simple:
+            return 1.0
+
+        if self.remaster_pattern.match(search_result_title_simple):
+            return 0.9
+
+        if self.variant_pattern.match(search_result_title_simple):
+            return 0.6
+
+        if self.live_base_title is not None:
+            unplugged_match = unplugged_pattern.match(search_result_title_simple)
+            if unplugged_match and unplugged_match.groups()[0] == self.live_base_title:
+                return 0.5
+
+        return 0
+
+
+@lru_cache(maxsize=1024)
+def title_matcher(expected_title, expected_title_simple):
+    """
+    :return: TitleMatcher for the given title, reused for as long as it stays in the cache
+    """
+    return TitleMatcher(expected_title, expected_title_simple)
+
+
+class SongSearch(object):
+    """
+    State of the search for the tracks matching a song: the planned queries, and the best matches found so far.
+    """
+
+    def __init__(self, song, planned_queries):
+        """
+        :param song: rphistory.Song object
+        :param planned_queries: list of (query kind, query info tuple), as returned by TrackSearch.planned_queries()
+        """
+        self.song = song
+        self.planned_queries = planned_queries
+        self.best_matches = {}
+        self.matches_score = {}
+        # Countries for which the best match was identified by its ISRC:
+        self.isrc_countries = set()
+        self.queries_scored = 0
+        self.complete = False
+
+    def queries_of_kind(self, kind):
+        return [query_info for query_kind, query_info in self.planned_queries if query_kind == kind]
+
+
 # TODO: map multiple song "songs" played on rp to multiple songs.
 # Examples: rp_song_ids: 33058 (Yes), 38699 (Led Zep)
 
@@ -66,6 +151,16 @@ class TrackSearch(object):
     ISRC_TRACK_MATCH_SCORE = 1.0
     ISRC_ARTIST_MATCH_SCORE = 0.9
 
+    # Highest possible score: track title, all artists, album title and album release year match.
+    PERFECT_MATCH_SCORE = 400
+
+    QUERY_KIND_ISRC = 'isrc'
+    QUERY_KIND_ARTISTS = 'artists'
+    QUERY_KIND_ANY_OF = 'any_of'
+    # The order in which the kinds of queries are run.  Queries that are most likely to find the best match
+    # come first, so that the remaining queries can often be skipped.
+    QUERY_PLAN = (QUERY_KIND_ISRC, QUERY_KIND_ARTISTS, QUERY_KIND_ANY_OF)
+
     rp_to_spotify_artist_map = {
         MAPPING_TYPE_REPLACE: {
             '!Deladap': '!Dela Dap',  # Spotify seems wrong on this one
@@ -180,47 +275,45 @@ class TrackSearch(object):
     }
 
 
-    # Characters that can be stripped when comparing possible matches:
-    strip_chars_pattern = re.compile('[{}]'.format(re.escape(string.punctuation + ' ')))
-
-    # Characters that can be stripped when querying Spotify for a match:
-    search_strip_chars_pattern = re.compile('[{}]'.format(
-        re.escape(string.punctuation.replace('-', '') \
-                  .replace('&', '').replace('$', '').replace('#', '').replace('+', '').replace('/', '')
-                  )))
-
-    # Match things like ", part 2":
-    part_x_pattern = re.compile(',? (\((pt\.|part) \d+\)|(pt\.|part \d+))')
-
-    # Match things like ", pt. 2", with a named group for the part number:
-    part_x_type1 = re.compile(',? ?(pt\.|part) (?P<part_number>\d+)')
-
-    # Match things like " (part 2)", with a named group for the part number:
-    part_x_type2 = re.compile(' ?\((pt\.|part) (?P<part_number>\d+)\)')
-
-    # Match things like "(w/ Markus Garvey)" and "feat. Jerry Garcia":
-    featuring_pattern = re.compile('\((w/|feat\.?|featuring) (?P<featuring>[^\)]+)\)')
-
-    contains_featuring_pattern = re.compile('^.*' + featuring_pattern.pattern + '.*$')
-
-    # Match all non-alphanumeric characters (unicode aware):
-    strip_non_words_pattern = re.compile('[\W_]+', re.UNICODE)
-
-    # Match text like .*(live|acoustic)
-    live_pattern = re.compile(r'^(.*?)(live|acoustic)$')
-
-    # Match text like .*(\(live|acoustic\))
-    live_raw_pattern = re.compile(r'^(.*?)\s*\(\s*(live|acoustic)\s*\)\s*$', re.IGNORECASE)
-
-    # Match text like .*(live|acoustic)
-    unplugged_pattern = re.compile(r'^(.*?)((mtvunplugged(version)?)|unpluggedversion)$')
-
-    def __init__(self, query_limit=40, max_items_to_process=200):
-        self.spotify = spotify()
+    def __init__(self, query_limit=40, max_items_to_process=200, max_workers=None, use_response_cache=True,
+                 paging_stop_score=TRACKMAP_PAGING_STOP_SCORE):
+        """
+        :param int query_limit: number of results to request per page
+        :param int max_items_to_process: max number of results to process per query
+        :param paging_stop_score: stop fetching further pages of a query's results once an item with at least
+                                  this score is found (see is_good_enough_match()).  None fetches all pages.
+        :param int max_workers: number of threads used to run Spotify requests concurrently.
+                                Defaults to TRACKMAP_SPOTIFY_QUERY_WORKERS; 1 runs all requests sequentially.
+        :param bool use_response_cache: use cached Spotify search and album responses, if available
+        """
+        self.spotify = cached_spotify() if use_response_cache else spotify()
         self.query_limit = query_limit
         self.max_items_to_process = max_items_to_process
+        if max_workers is None:
+            max_workers = TRACKMAP_SPOTIFY_QUERY_WORKERS
+        self.max_workers = max(1, max_workers)
+        self.paging_stop_score = paging_stop_score
+        # Counts of queries run / skipped, pages fetched / avoided, and of the kinds of queries that
+        # found the best matches:
+        self.query_stats = Counter()
+        self.query_stats_lock = threading.Lock()
 
     def spotify_query(self, song):
+        return [query_info for _, query_info in self.classified_spotify_query(song)]
+
+    def planned_queries(self, song):
+        """
+        :param song: rphistory.Song object
+        :return: list of (query kind, query info tuple), in the order given by QUERY_PLAN
+        """
+        plan_order = {kind: i for i, kind in enumerate(self.QUERY_PLAN)}
+        return sorted(self.classified_spotify_query(song), key=lambda kind_and_info: plan_order[kind_and_info[0]])
+
+    def classified_spotify_query(self, song):
+        """
+        :param song: rphistory.Song object
+        :return: list of (query kind, query info tuple)
+        """
         and_artist_names_for_search, or_artist_names_for_search = self.map_artist_names(song.artists.all(), 'search')
         and_artist_names_for_compare, or_artist_names_for_compare = self.map_artist_names(song.artists.all(), 'compare')
         title = song.corrected_title or song.title
@@ -231,16 +324,20 @@ class TrackSearch(object):
         query_info = []
         for artist_name in or_artist_names_for_search:
             query = self.build_query(title, artist_names=[artist_name])
-            query_info.append((query, title, and_artist_names_for_compare, or_artist_names_for_compare, None))
+            query_info.append((self.QUERY_KIND_ANY_OF,
+                               (query, title, and_artist_names_for_compare, or_artist_names_for_compare, None)))
             if isrc:
                 query = self.build_query(None, artist_names=[artist_name], isrc=isrc)
-                query_info.append((query, title, and_artist_names_for_compare, or_artist_names_for_compare, isrc))
+                query_info.append((self.QUERY_KIND_ISRC,
+                                   (query, title, and_artist_names_for_compare, or_artist_names_for_compare, isrc)))
         if and_artist_names_for_search:
             query = self.build_query(title, artist_names=and_artist_names_for_search)
-            query_info.append((query, title, and_artist_names_for_compare, or_artist_names_for_compare, None))
+            query_info.append((self.QUERY_KIND_ARTISTS,
+                               (query, title, and_artist_names_for_compare, or_artist_names_for_compare, None)))
             if isrc:
                 query = self.build_query(None, artist_names=and_artist_names_for_search, isrc=isrc)
-                query_info.append((query, title, and_artist_names_for_compare, or_artist_names_for_compare, isrc))
+                query_info.append((self.QUERY_KIND_ISRC,
+                                   (query, title, and_artist_names_for_compare, or_artist_names_for_compare, isrc)))
 
         return query_info
 
@@ -251,46 +348,168 @@ class TrackSearch(object):
         :param song: rphistory.Song object
         :return: tuple: (dict: best_matches, dict: matches_score)
         """
+        return self.find_matching_tracks_batch([song])[0]
+
+    def find_matching_tracks_batch(self, songs):
+        """
+        Gets the matching tracks that can be played per country, for each of the songs.
+
+        The queries are run in stages, one stage per kind of query in QUERY_PLAN.  In each stage, the queries
+        of all songs whose search is not yet complete are run concurrently, and the full album info for all
+        their results is fetched at once, so that each album is only requested once even if it is found by
+        several queries or for several songs.  A song's search is complete, and its remaining queries are
+        skipped, when its best matches can not be improved upon (see is_search_complete()).
+
+        :param songs: list of rphistory.Song objects
+        :return: list of tuples (dict: best_matches, dict: matches_score), in the same order as songs
+        """
+        searches = [SongSearch(song, self.planned_queries(song)) for song in songs]
+        for kind in self.QUERY_PLAN:
+            stage = [(search, search.queries_of_kind(kind)) for search in searches if not search.complete]
+            stage = [(search, query_infos) for search, query_infos in stage if query_infos]
+            if not stage:
+                continue
+
+            # Identical queries are only run once (e.g. ISRC queries, which do not include the artist names).
+            queries = []
+            seen_queries = set()
+            for search, query_infos in stage:
+                for query_info in query_infos:
+                    if query_info[0] not in seen_queries:
+                        seen_queries.add(query_info[0])
+                        queries.append((search, query_info))
+            query_results = self.map_concurrently(self.get_query_results_for_search, queries)
+            all_items = list(chain.from_iterable(query_results))
+            self.add_full_album_info(all_items)
+            add_simplified_names(all_items)
+            self.count('queries_run', len(queries))
+
+            results_by_query = {query_info[0]: results for (_, query_info), results in zip(queries, query_results)}
+            for search, query_infos in stage:
+                for query_info in query_infos:
+                    self.score_query_results(search, kind, query_info, results_by_query[query_info[0]])
+                search.complete = self.is_search_complete(search)
+
+        for search in searches:
+            self.count('queries_skipped', len(search.planned_queries) - search.queries_scored)
+            if search.best_matches:
+                best_country = max(search.matches_score, key=search.matches_score.get)
+                self.count('best_match_' + search.best_matches[best_country].query_kind)
+
+        return [(search.best_matches, search.matches_score) for search in searches]
+
+    def count(self, name, value=1):
+        with self.query_stats_lock:
+            self.query_stats[name] += value
+
+    def get_query_results_for_search(self, search_and_query_info):
+        """
+        Gets the results of a query, stopping early if is_good_enough_match() is True for an item.
+
+        :param search_and_query_info: tuple (SongSearch, query info tuple)
+        :return: array of track items
+        """
+        search, query_info = search_and_query_info
+        stop_when = None
+        if self.paging_stop_score is not None:
+            stop_when = lambda item: self.is_good_enough_match(search.song, query_info, item)
+        return self.get_query_results(query_info[0], stop_when=stop_when)
+
+    def is_good_enough_match(self, song, query_info, item):
+        """
+        Checks if an item from the search results is a good enough match that no further pages of results
+        need to be fetched: it matches the ISRC, or its score reaches self.paging_stop_score.
+
+        The full album info is not yet available, so the album release year is not taken into account.
+
+        :param song: rphistory.Song object
+        :param query_info: query info tuple, as returned by spotify_query(song)
+        :param item: spotify search result item
+        :return: bool
+        """
+        query, title, and_artist_names, or_artist_names, isrc = query_info
+        if self.item_has_matching_isrc(item, isrc):
+            return True
+
+        track_info = self.extract_track_info(title, item, isrc)
+        if track_info is None:
+            return False
+
+        artist_info = self.extract_artist_info(song, and_artist_names, or_artist_names, item, isrc)
+        if artist_info is None:
+            return False
+
+        album_score = int(simplified_name(item['album']) == simplify(song.album.title))
+        return (track_info.match_score + artist_info.match_score + album_score) * 100 >= self.paging_stop_score
+
+    def is_search_complete(self, search):
+        """
+        A search is complete when, for every country, the best match found can not be improved upon:
+        it either has the perfect score, or the track was identified by its ISRC.
+
+        :param SongSearch search:
+        :return: bool
+        """
+        return bool(search.matches_score) and all(
+            score >= self.PERFECT_MATCH_SCORE or country in search.isrc_countries
+            for country, score in search.matches_score.items())
+
+    def score_query_results(self, search, query_kind, query_info, results):
+        """
+        Updates the search's best match per country with the results of one of the song's queries.
+
+        :param SongSearch search:
+        :param str query_kind: one of the QUERY_KIND_* values
+        :param query_info: query info tuple, as returned by spotify_query(song)
+        :param results: array of track items (with full album info) returned by the query
+        :return: None
+        """
 
         #TODO: a fair number of the songs that fail to match fail because the song title is slightly different
         #      between radio paradise and spotify.  It might be worth a second pass that tries to find
         #      a song whose name almost matches on the album, if the album can be matched.
 
-        best_matches = {}
-        matches_score = {}
-        for query, title, and_artist_names, or_artist_names, isrc in self.spotify_query(song):
-            results = self.get_query_results(query)
-            self.add_full_album_info(results)
-            # TODO: check if any album_info matches were found.  If not, try to find album via asin.
-            #       If asin album found and title not the same as original album title used in query,
-            #       re-run query with asin album title and asin artists.
-            #       # TODO: update rphistory album title and artists info?
-            for item in results:
-                # If the artist or track are not found, no need to process this item.
-                track_info = self.extract_track_info(title, item, isrc)
-                if track_info is None:
-                    continue
-
-                artist_info = self.extract_artist_info(song, and_artist_names, or_artist_names, item, isrc)
-                if artist_info is None:
-                    continue
-
-                album_info = self.extract_album_info(song.album.title, song.album.release_year, item)
-
-                # Find the best match per country.
-                score = sum(info.match_score for info in [track_info, artist_info, album_info]) * 100
-                # 2019-03: Spotify seems to have removed the 'available_markets' info altogether.
-                # As a workaround, use just the swiss market.
-                markets = item.get('available_markets', ['CH'])
-                for country in markets:
-                    previous_score = matches_score.get(country, -1)
-                    if score > previous_score:
-                        matches_score[country] = score
-                        best_matches[country] = TrackArtistAlbum(
-                            track_info=track_info, artist_info=artist_info, album_info=album_info
-                        )
-
-        return best_matches, matches_score
+        song = search.song
+        best_matches = search.best_matches
+        matches_score = search.matches_score
+        query, title, and_artist_names, or_artist_names, isrc = query_info
+        search.queries_scored += 1
+
+        # Queries are scored in the planned order; for equal scores, the match found first is kept.
+
+        # TODO: check if any album_info matches were found.  If not, try to find album via asin.
+        #       If asin album found and title not the same as original album title used in query,
+        #       re-run query with asin album title and asin artists.
+        #       # TODO: update rphistory album title and artists info?
+        for item in results:
+            # If the artist or track are not found, no need to process this item.
+            track_info = self.extract_track_info(title, item, isrc)
+            if track_info is None:
+                continue
+
+            artist_info = self.extract_artist_info(song, and_artist_names, or_artist_names, item, isrc)
+            if artist_info is None:
+                continue
+
+            album_info = self.extract_album_info(song.album.title, song.album.release_year, item)
+
+            # Find the best match per country.
+            score = sum(info.match_score for info in [track_info, artist_info, album_info]) * 100
+            # 2019-03: Spotify seems to have removed the 'available_markets' info altogether.
+            # As a workaround, use just the swiss market.
+            markets = item.get('available_markets', ['CH'])
+            for country in markets:
+                previous_score = matches_score.get(country, -1)
+                if score > previous_score:
+                    matches_score[country] = score
+                    best_matches[country] = TrackArtistAlbum(
+                        track_info=track_info, artist_info=artist_info, album_info=album_info,
+                        query_kind=query_kind
+                    )
+                    if self.item_has_matching_isrc(item, isrc):
+                        search.isrc_countries.add(country)
+                    else:
+                        search.isrc_countries.discard(country)
 
     def create_tracks(self, song, market_tracks, market_scores):
         """
@@ -301,40 +520,134 @@ class TrackSearch(object):
         :param market_scores: map of country name string => match score
         :return: list of TrackAvailability objects
         """
-        availabilities = []
-        track_cache = {}
-        for country, info in market_tracks.items():
-            spotify_id = info.track_info.id
-            track = track_cache.get(spotify_id, None)
-            if not track:
-                try:
-                    track = self.get_or_create_track(info.track_info, info.artist_info, info.album_info)
-                    track_cache[spotify_id] = track
-                except IntegrityError as e:
-                    log.warn("Problem (db integrity error)creating track for rp song {}: {}".format(song.rp_song_id, e))
-                    continue
-            track_availability = TrackAvailability(
-                track=track, rp_song=song, country=country, score=market_scores[country])
-            track_availability.full_clean(validate_unique=False)
-            availabilities.append(track_availability)
-        return availabilities
+        return self.create_tracks_batch([(song, market_tracks, market_scores)])[0]
+
+    @transaction.atomic
+    def create_tracks_batch(self, song_matches):
+        """
+        Creates or updates the album and track objects for the matches of several songs, and collects the
+        per-market TrackAvailability objects for each song.
+
+        The albums and tracks of all songs are upserted together, so the number of queries made does
+        not depend on the number of songs or matches.  If that fails with an integrity error, the tracks
+        are created one at a time, and the markets whose track can not be created are left out.
+
+        :param song_matches: list of tuples (song, market_tracks, market_scores), see create_tracks()
+        :return: list of lists of (unsaved) TrackAvailability objects, in the same order as song_matches
+        """
+        try:
+            with transaction.atomic():
+                track_ids = self.upsert_tracks(
+                    [info for _, market_tracks, _ in song_matches for info in market_tracks.values()])
+        except IntegrityError as e:
+            log.warn("Problem (db integrity error) creating tracks for {} songs, creating them one at a time: "
+                     "{}".format(len(song_matches), e))
+            track_ids = {}
+            failed_track_ids = set()
+            for song, market_tracks, _ in song_matches:
+                for info in market_tracks.values():
+                    spotify_id = info.track_info.id
+                    if spotify_id in track_ids or spotify_id in failed_track_ids:
+                        continue
+                    try:
+                        with transaction.atomic():
+                            track_ids.update(self.upsert_tracks([info]))
+                    except IntegrityError as e:
+                        log.warn("Problem (db integrity error) creating track for rp song {}: {}".format(
+                            song.rp_song_id, e))
+                        failed_track_ids.add(spotify_id)
+
+        return [
+            [
+                TrackAvailability(
+                    track_id=track_ids[info.track_info.id], rp_song=song, country=country,
+                    score=market_scores[country])
+                for country, info in market_tracks.items()
+                if info.track_info.id in track_ids
+            ]
+            for song, market_tracks, market_scores in song_matches
+        ]
+
+    def upsert_tracks(self, infos):
+        """
+        Creates or updates the albums and tracks.
+
+        :param infos: list of TrackArtistAlbum namedtuples
+        :return: dict of track spotify_id => Track id
+        """
+        album_ids = Album.objects.upsert([
+            {
+                'spotify_id': info.album_info.id,
+                'title': info.album_info.title,
+                'img_small_url': info.album_info.img_small,
+                'img_medium_url': info.album_info.img_medium,
+                'img_large_url': info.album_info.img_large,
+            }
+            for info in infos
+        ])
+        return Track.objects.upsert([
+            {
+                'spotify_id': info.track_info.id,
+                'title': info.track_info.title,
+                'album_id': album_ids[info.album_info.id],
+                'artist': info.artist_info.name,
+                'artist_id': info.artist_info.id,
+                'many_artists': info.artist_info.multiple,
+            }
+            for info in infos
+        ])
 
     @transaction.atomic
     def update_db_with_availibility(self, song, track_availabilities):
         """
-        Atomically deletes previous track availability data and inserts new data
+        Atomically replaces the previous track availability data with the new data.
+
+        Only the differences are written: availabilities that no longer exist are deleted, new ones are
+        inserted, and existing ones are only updated if their score changed.
 
         :param song: rphistory.Song object
         :param track_availabilities: array of TrackAvailability objects
-        :return:
+        :return: Counter with the number of availabilities 'inserted', 'updated', 'deleted' and 'unchanged'
         """
-        TrackAvailability.objects.filter(rp_song=song).delete()
-        if track_availabilities:
-            TrackAvailability.objects.bulk_create(track_availabilities)
+        changes = Counter()
+        existing = {
+            (track_id, country): (availability_id, score)
+            for availability_id, track_id, country, score in TrackAvailability.objects.filter(
+                rp_song=song).values_list('id', 'track_id', 'country', 'score')
+        }
+
+        to_insert = []
+        ids_by_new_score = {}
+        for availability in track_availabilities:
+            key = (availability.track_id, availability.country)
+            if key not in existing:
+                to_insert.append(availability)
+                continue
+            availability_id, score = existing.pop(key)
+            if score == availability.score:
+                changes['unchanged'] += 1
+            else:
+                ids_by_new_score.setdefault(availability.score, []).append(availability_id)
+
+        # Whatever is left in existing is no longer available.
+        if existing:
+            removed_ids = [availability_id for availability_id, _ in existing.values()]
+            TrackAvailability.objects.filter(id__in=removed_ids).delete()
+            changes['deleted'] += len(existing)
+        for score, ids in ids_by_new_score.items():
+            changes['updated'] += TrackAvailability.objects.filter(id__in=ids).update(score=score)
+        if to_insert:
+            TrackAvailability.objects.bulk_create(to_insert)
+            changes['inserted'] += len(to_insert)
+
+        if changes['inserted'] or changes['updated'] or changes['deleted']:
+            song_tracks_changed.send(sender=TrackAvailability, song_ids=[song.id])
+
+        return changes
 
     def artist_query_fragment(self, artist_name):
         search_artist = self.rp_to_spotify_artist_map[self.REPLACE_FOR_SEARCH_ONLY].get(artist_name, artist_name)
-        search_artist = self.prepare_text_for_search(search_artist)
+        search_artist = prepare_for_search(search_artist)
         return 'artist:"{}"'.format(search_artist)
 
     def build_query(self, track_title, artist_names=None, album_title=None, isrc=None):
@@ -353,8 +666,8 @@ class TrackSearch(object):
         if isrc:
             q = ['isrc:"{}"'.format(isrc)]
         else:
-            search_track = self.strip_live_marker(track_title)
-            search_track = self.prepare_text_for_search(search_track)
+            search_track = strip_live_marker(track_title)
+            search_track = prepare_for_search(search_track)
             q = ['track:"{}"'.format(search_track)]
 
             if artist_names:
@@ -362,12 +675,30 @@ class TrackSearch(object):
                     q.append(self.artist_query_fragment(name))
 
             if album_title:
-                search_album = self.prepare_text_for_search(album_title)
+                search_album = prepare_for_search(album_title)
                 q.append('album:"{}"'.format(search_album))
 
         return ' '.join(q)
 
-    def get_query_results(self, query, limit=None, max_items=None):
+    def map_concurrently(self, func, args_list):
+        """
+        Calls func once for each value in args_list, using up to self.max_workers threads.
+
+        Exceptions raised by func are propagated to the caller.  The worker threads make their Spotify
+        requests with the request priority of the calling thread.
+
+        :param func: callable taking a single argument
+        :param list args_list: arguments to call func with
+        :return: list of results, in the same order as args_list
+        """
+        workers = min(self.max_workers, len(args_list))
+        if workers <= 1:
+            return [func(args) for args in args_list]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(with_current_priority(func), args_list))
+
+    def get_query_results(self, query, limit=None, max_items=None, stop_when=None):
         """
         Gets as many query results as specified; handles Spotify's paging API.
 
@@ -375,37 +706,61 @@ class TrackSearch(object):
         E.g. with limit=5, max_items=7, you will get two full pages of results (10 items) if there are
         that many possible results.
 
+        After the first page, the remaining pages are fetched up to self.max_workers pages at a time.
+        If stop_when is given, no further pages are fetched once it returns True for an item received.
+
         :param query: query dict like the one returned from build_query()
         :param limit: limit-per-page; defaults to self.query_limit
         :param max_items: max tracks to accumulate before returning.
+        :param stop_when: optional callable taking a track item and returning a bool
         :return: array of track items
         """
         limit = limit or self.query_limit
         max_items = max_items or self.max_items_to_process
-        all_items = []
-        total = 0
-        offset = 0
-        keep_going = True
-        while keep_going:
-            # TODO: undo workaround after Spotify fixes the bug:
-            # Workaround for https://github.com/spotify/web-api/issues/194 .
-            # This workaround adds the CH market; the result is that tracks for the US/CA/MX
-            # markets are (mostly, at least) excluded.
-            # Without this workaround (e.g. without supplying any market parameter),
-            # only tracks for US/CA/MX are found.
-            # original line: results = self.spotify.search(q=query, type='track', limit=limit, offset=offset)
-            results = self.spotify.search(q=query, type='track', limit=limit, offset=offset, market='CH')
-            items = results['tracks']['items']
-            count = len(items)
-            if count:
-                all_items += items
-                total += count
-                offset += count
-            keep_going = results['tracks']['next'] and total < max_items
-            if total > max_items:
-                log.warn("The query '{}' returned more than max_items={} results!".format(query, max_items))
+
+        def fetch_page(offset):
+            return self.get_query_results_page(query, limit, offset)
+
+        def satisfied(items):
+            return stop_when is not None and any(stop_when(item) for item in items)
+
+        first_page = fetch_page(0)
+        all_items = list(first_page['items'])
+        offsets = []
+        if first_page['next'] and len(all_items) < max_items:
+            offsets = list(range(len(all_items), min(first_page['total'], max_items), limit))
+        pages_needed = 1 + len(offsets)
+        pages_fetched = 1
+
+        done = satisfied(all_items)
+        while offsets and not done:
+            wave, offsets = offsets[:self.max_workers], offsets[self.max_workers:]
+            pages = self.map_concurrently(fetch_page, wave)
+            pages_fetched += len(wave)
+            items = list(chain.from_iterable(page['items'] for page in pages))
+            all_items += items
+            done = satisfied(items)
+
+        self.count('pages_fetched', pages_fetched)
+        self.count('pages_avoided', pages_needed - pages_fetched)
+        if len(all_items) > max_items:
+            log.warn("The query '{}' returned more than max_items={} results!".format(query, max_items))
         return all_items
 
+    def get_query_results_page(self, query, limit, offset):
+        """
+        :return: dict: the 'tracks' paging object of the search results
+        """
+        # TODO: undo workaround after Spotify fixes the bug:
+        # Workaround for https://github.com/spotify/web-api/issues/194 .
+        # This workaround adds the CH market; the result is that tracks for the US/CA/MX
+        # markets are (mostly, at least) excluded.
+        # Without this workaround (e.g. without supplying any market parameter),
+        # only tracks for US/CA/MX are found.
+        # original line: results = self.spotify.search(q=query, type='track', limit=limit, offset=offset)
+        results = self.spotify.search(q=query, type='track', limit=limit, offset=offset, market='CH')
+        return results['tracks']
+
     def add_full_album_info(self, items):
         """
         Adds full album info for the retrieved results, and adds a ``release_year`` element to the full album info.
@@ -422,8 +777,8 @@ class TrackSearch(object):
         id_lists = chunks(list(album_ids), max_ids)
 
         album_info = {}
-        for id_list in id_lists:
-            for album in self.spotify.albums(id_list)['albums']:
+        for albums in self.map_concurrently(self.spotify.albums, id_lists):
+            for album in albums['albums']:
                 album['release_year'] = album['release_date'].split('-')[0]
                 album_info[album['id']] = album
 
@@ -431,9 +786,9 @@ class TrackSearch(object):
             item['album'] = album_info[item['album']['id']]
 
     def match_artist(self, artist, artist_list):
-        artist_simple = self.simplified_text(artist)
+        artist_simple = simplify(artist)
         for a in artist_list:
-            a_simple = self.simplified_text(a['name'])
+            a_simple = simplified_name(a)
             if a_simple == artist_simple:
                 return 1.0, a
 
@@ -507,8 +862,8 @@ class TrackSearch(object):
 
     def extract_album_info(self, expected_album, expected_year, item):
         album = item['album']
-        expected_simple = self.simplified_text(expected_album)
-        item_simple = self.simplified_text(album['name'])
+        expected_simple = simplify(expected_album)
+        item_simple = simplified_name(album)
         item_year = int(album['release_year'])
         match_score = int(item_simple == expected_simple)
         if match_score:
@@ -540,23 +895,23 @@ class TrackSearch(object):
         if self.item_has_matching_isrc(item, isrc):
             return TrackInfo(id=item['id'], title=item['name'], match_score=self.ISRC_TRACK_MATCH_SCORE)
 
-        track_simple = self.simplified_text(track_title)
-        item_track_simple = self.simplified_text(item['name'])
+        track_simple = simplify(track_title)
+        item_track_simple = simplified_name(item)
 
         match_score = self.track_info_match(track_title, track_simple, item_track_simple)
 
-        if not match_score and self.contains_featuring_pattern.match(track_title):
+        if not match_score and contains_featuring_pattern.match(track_title):
             # Retry without the "featuring" text
-            track_simple = self.simplified_text(track_title, leave_feature=False)
+            track_simple = simplify(track_title, leave_feature=False)
             match_score = self.track_info_match(track_title, track_simple, item_track_simple)
             if match_score:
                 match_score -= 0.1
 
         if not match_score:
-            stripped = self.strip_live_marker(track_title)
+            stripped = strip_live_marker(track_title)
             if stripped != track_title:
                 # Retry without the "live" text
-                track_simple = self.simplified_text(stripped, leave_feature=False)
+                track_simple = simplify(stripped, leave_feature=False)
                 match_score = self.track_info_match(track_title, track_simple, item_track_simple)
                 if match_score:
                     match_score -= 0.2
@@ -569,91 +924,7 @@ class TrackSearch(object):
         return None
 
     def track_info_match(self, expected_title, expected_title_simple, search_result_title_simple):
-        match_score = 1.0
-        track_match = expected_title_simple == search_result_title_simple
-
-        if not track_match:
-            # Accept things like "the <song name> 2004 remaster":
-            match_score = 0.9
-            regex = r"^(the)?" + expected_title_simple + r"(\d{4})?((digital)?(remaster(ed)?)(version)?)?"
-            track_match = re.match(regex, search_result_title_simple)
-
-            if not track_match:
-                # Accept things like "the <song name> - instrumental ":
-                match_score = 0.6
-                regex = r"^(the)?" + expected_title_simple + r"(instrumental|vocal|acoustic|live|original)?"
-                track_match = re.match(regex, search_result_title_simple)
-
-                if not track_match:
-                    # Sometimes there are songs like "Song (live)" that should match "Song [MTV Unplugged Version]"
-                    match_score = 0.5
-                    if '(' in expected_title:
-                        try:
-                            base_track = self.live_pattern.match(expected_title_simple).groups()[0]
-                            base_item = self.unplugged_pattern.match(search_result_title_simple).groups()[0]
-                            track_match = base_track == base_item
-                        except:
-                            # One of regexes failed to match ... give up.
-                            pass
-
-                    if not track_match:
-                        match_score = 0
-
-        return match_score
-
-    @transaction.atomic
-    def get_or_create_track(self, track_info, artist_info, album_info):
-        """
-        Gets or creates the track, also getting or creating the album.
-
-        :param TrackInfo track_info:
-        :param ArtistInfo artist_info:
-        :param AlbumInfo album_info:
-        :return: Track
-        """
-        album_defaults = {
-            'title': album_info.title,
-            'img_small_url': album_info.img_small,
-            'img_medium_url': album_info.img_medium,
-            'img_large_url': album_info.img_large,
-            }
-        album_obj = self.get_or_create_and_update_if_needed(Album, {'spotify_id': album_info.id}, album_defaults)
-
-        track_defaults = {
-            'title': track_info.title,
-            'album': album_obj,
-            'artist': artist_info.name,
-            'artist_id': artist_info.id,
-            'many_artists': artist_info.multiple,
-            }
-        track_obj = self.get_or_create_and_update_if_needed(Track, {'spotify_id': track_info.id}, track_defaults)
-        return track_obj
-
-    def get_or_create_and_update_if_needed(self, model, kwargs, defaults):
-        """
-        Similar to Django's get_or_create / update_or_create, but only updates if something changed.
-
-        :param model: model class
-        :param kwargs: dict of field/value pairs used to identify an existing object
-        :param defaults: dict of field/value paris that will be used for other, non-identifying fields
-        :return:
-        """
-        # TODO: should clean before creating, too.
-        obj, created = model.objects.get_or_create(defaults=defaults, **kwargs)
-
-        # Save back to DB if any info has changed.
-        if not created:
-            clean_exclude = list(kwargs)
-            changed = False
-            for k, v in defaults.items():
-                if getattr(obj, k) != v:
-                    changed = True
-                    setattr(obj, k, v)
-                else:
-                    clean_exclude.append(k)
-            if changed:
-                obj.full_clean(exclude=clean_exclude, validate_unique=False)
-        return obj
+        return title_matcher(expected_title, expected_title_simple).score(search_result_title_simple)
 
     # TODO: should these be managed in the DB?
     def map_artist_names(self, artists, for_action):
@@ -689,72 +960,6 @@ class TrackSearch(object):
 
         return and_artists, or_artists
 
-    def simplified_text(self, string, leave_feature=True):
-        string = string.lower().replace(' & ', ' and ').replace(' + ', ' and ')
-        string = re.sub(self.part_x_type1, ' part\g<part_number>', string)
-        string = re.sub(self.part_x_type2, ' part\g<part_number>', string)
-        string = self.remove_featuring(string, leave_feature=leave_feature)
-        string = self.remove_leading_article(string)
-        string = remove_accents(self.strip_non_words_pattern.sub('', string))
-        return re.sub(self.strip_chars_pattern, '', string)
-
-    def prepare_text_for_search(self, text):
-        """
-        Remove accents and remove leading 'a ' or 'the ', and punctuation characters.
-        """
-        if text is None:
-            return None
-
-        plain_text = remove_accents(text).strip().lower()
-        plain_text = self.remove_leading_article(plain_text)
-        plain_text = self.remove_part_x(plain_text)
-        plain_text = self.remove_featuring(plain_text, leave_feature=False)
-        plain_text = self.search_strip_chars_pattern.sub('', plain_text)
-        return plain_text.strip()
-
-    def remove_leading_article(self, text):
-        """
-        Remove a leading 'a ' or 'the ', but only if the remaining string is at least 3 characters long.
-
-        :param str text:
-        :return: str
-        """
-        if text.startswith('a '):
-            stripped_text = text[2:]
-        elif text.startswith('the '):
-            stripped_text = text[4:]
-        else:
-            return text
-
-        if len(stripped_text) < 3:
-            return text
-
-        return stripped_text
-
-    def remove_part_x(self, text):
-        return re.sub(self.part_x_pattern, '', text)
-
-    def remove_featuring(self, text, leave_feature):
-        """
-        Transform things like "(w/ foo)" or "(featuring foo)" to simply "featuring foo" (or remove it completely)
-
-        :param text:
-        :param leave_feature: if True, do not remove "foo" if (w/ foo) is matched.  if False, remove the entire match.
-        :return:
-        """
-
-        if leave_feature:
-            return re.sub(self.featuring_pattern, 'featuring \g<featuring>', text)
-        else:
-            return re.sub(self.featuring_pattern, '', text)
-
-    def strip_live_marker(self, track_title):
-        match = self.live_raw_pattern.match(track_title)
-        if match:
-            return match.groups()[0]
-        else:
-            return track_title
-
     def item_has_matching_isrc(self, item, isrc):
         """
         Check if the ISRC matches.